@@ -0,0 +1,104 @@
+""" Binary snapshots of the particle filter state, so that a respawned filter node can resume tracking on its first
+    scan instead of re-localizing from scratch """
+import os
+import threading
+import time
+
+import numpy as np
+
+import rospy
+
+# bump this whenever the layout of a checkpoint changes, older checkpoints are then ignored
+VERSION = 2
+
+
+class FilterCheckpoint:
+    """ A snapshot of the state of a particle filter
+        Attributes:
+            particles: an n x 4 numpy array of particle x, y, theta and weight
+            odom_xy_theta: the odometry pose of the last filter update (current_odom_xy_theta)
+            translation: the translation of the map to odom transform
+            rotation: the rotation (quaternion) of the map to odom transform
+            map_hash: the fingerprint of the map the particles live in (see OccupancyField.fingerprint)
+            stamp: the wall clock time the snapshot was taken
+            odom_frame: the frame odom_xy_theta is expressed in
+            odom_stamp: the (ROS) time of the scan odom_xy_theta was taken at, in seconds
+    """
+
+    def __init__(self, particles, odom_xy_theta, translation, rotation, map_hash, stamp=None, odom_frame="",
+                 odom_stamp=0.0):
+        self.particles = np.asarray(particles, dtype=float).reshape(-1, 4)
+        self.odom_xy_theta = np.asarray(odom_xy_theta, dtype=float).ravel()
+        self.translation = np.asarray(translation, dtype=float).ravel()
+        self.rotation = np.asarray(rotation, dtype=float).ravel()
+        self.map_hash = map_hash
+        self.stamp = time.time() if stamp is None else stamp
+        self.odom_frame = odom_frame
+        self.odom_stamp = odom_stamp
+
+    def save(self, filename):
+        """ Write the checkpoint to filename.  The data goes to a temporary file first which then replaces filename,
+            so a crash halfway through never leaves a truncated checkpoint behind """
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary = filename + ".tmp"
+        with open(temporary, "wb") as f:
+            np.savez(f, version=VERSION, particles=self.particles, odom_xy_theta=self.odom_xy_theta,
+                     translation=self.translation, rotation=self.rotation, map_hash=self.map_hash,
+                     stamp=self.stamp, odom_frame=self.odom_frame, odom_stamp=self.odom_stamp)
+        os.rename(temporary, filename)
+
+    @staticmethod
+    def load(filename):
+        """ Read the checkpoint in filename.  Returns None if there is no (readable) checkpoint of this version """
+        if not os.path.exists(filename):
+            return None
+        try:
+            with np.load(filename) as data:
+                if int(data["version"]) != VERSION:
+                    rospy.logwarn("ignoring checkpoint %s, it has version %d instead of %d", filename,
+                                  int(data["version"]), VERSION)
+                    return None
+                return FilterCheckpoint(data["particles"], data["odom_xy_theta"], data["translation"],
+                                        data["rotation"], str(data["map_hash"]), float(data["stamp"]),
+                                        str(data["odom_frame"]), float(data["odom_stamp"]))
+        except Exception as e:
+            rospy.logwarn("ignoring unreadable checkpoint %s: %s", filename, e)
+            return None
+
+
+class CheckpointWriter:
+    """ Writes checkpoints to disk on a background thread so the filter update never waits for the disk.  Only the
+        latest checkpoint matters, one that is submitted while the previous one is still being written replaces
+        any older one that is still waiting.
+        Attributes:
+            filename: where the checkpoints are written
+            pending: the checkpoint waiting to be written (None if there is none)
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.pending = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, checkpoint):
+        """ Queue checkpoint to be written """
+        with self.condition:
+            self.pending = checkpoint
+            self.condition.notify()
+
+    def run(self):
+        """ The writer thread, writes checkpoints as they come in """
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                checkpoint, self.pending = self.pending, None
+            try:
+                checkpoint.save(self.filename)
+            except Exception as e:
+                rospy.logwarn("failed to write checkpoint %s: %s", self.filename, e)
@@ -0,0 +1,183 @@
+""" Records the history of the particle cloud (every stage of every update) to a compact binary file, so filter
+    behaviour can be looked at offline without bagging the PoseArray topics.
+
+    The file starts with a short header (MAGIC and VERSION) followed by chunks, one per flush of the recorder:
+        a CHUNK_HEADER (magic, number of frames, number of particle rows)
+        n_frames FRAME_DTYPE records (stamp, stage, first row and number of rows of each frame)
+        n_rows particle rows of x, y, theta, weight and multiplicity (float64)
+    Everything is little endian and fixed size, so CloudHistory can memory map a recording (even one that is still
+    being written) and hand out the particles of any frame without reading the rest of the file.
+"""
+import collections
+import threading
+
+import numpy as np
+
+import rospy
+
+MAGIC = b"PFCLOUDS"
+# bump this whenever the layout of a recording changes
+VERSION = 1
+FILE_HEADER = np.dtype([("magic", "S8"), ("version", "<u4"), ("reserved", "<u4")])
+CHUNK_HEADER = np.dtype([("magic", "S4"), ("n_frames", "<u4"), ("n_rows", "<u8")])
+CHUNK_MAGIC = b"PFCK"
+FRAME_DTYPE = np.dtype([("stamp", "<f8"), ("stage", "<u4"), ("count", "<u4"), ("offset", "<u8")])
+ROW_COLUMNS = 5  # x, y, theta, w, m
+
+# the stages of a filter update, in the order they happen (the index is what ends up in the file)
+STAGES = ("raw", "odom", "laser", "resample", "final")
+
+
+class CloudRecorder:
+    """ Collects particle clouds in a ring buffer and appends them to a recording on a background thread, so the
+        filter update only pays for copying the particles.  If the disk can't keep up the oldest frames that haven't
+        been written yet are dropped.
+        Attributes:
+            filename: the recording being written
+            frames: the ring buffer of (stamp, stage, particles) frames waiting to be written
+            flush_period: how often (in seconds) the buffer is written out as a chunk
+            n_recorded: the number of frames handed to record
+            n_dropped: the number of frames that fell out of the ring buffer before they were written
+    """
+
+    def __init__(self, filename, capacity=1000, flush_period=1.0):
+        """ Start a new recording in filename (an existing file is replaced).
+                capacity: the number of frames the ring buffer holds
+                flush_period: how often (in seconds) the buffer is written out """
+        self.filename = filename
+        self.frames = collections.deque(maxlen=capacity)
+        self.flush_period = flush_period
+        self.n_recorded = 0
+        self.n_dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+        self.file = open(filename, "wb")
+        header = np.zeros(1, dtype=FILE_HEADER)
+        header["magic"] = MAGIC
+        header["version"] = VERSION
+        self.file.write(header.tobytes())
+        self.file.flush()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, stage, stamp, particles):
+        """ Add a frame to the recording.
+                stage: one of STAGES
+                stamp: the time of the frame in seconds (the stamp of the scan being processed)
+                particles: an n x 5 array of particle x, y, theta, weight and multiplicity (it is copied) """
+        frame = (stamp, STAGES.index(stage), np.array(particles, dtype="<f8").reshape(-1, ROW_COLUMNS))
+        with self.condition:
+            if len(self.frames) == self.frames.maxlen:
+                self.n_dropped += 1
+            self.frames.append(frame)
+            self.n_recorded += 1
+
+    def run(self):
+        """ The writer thread, writes out the ring buffer every flush_period """
+        while True:
+            with self.condition:
+                if not self.closed:
+                    self.condition.wait(self.flush_period)
+                frames = list(self.frames)
+                self.frames.clear()
+                closed = self.closed
+            try:
+                self.write_chunk(frames)
+            except Exception as e:
+                rospy.logwarn("failed to write to particle cloud recording %s: %s", self.filename, e)
+            if closed:
+                self.file.close()
+                return
+
+    def write_chunk(self, frames):
+        """ Append frames to the recording as one chunk """
+        if not frames:
+            return
+        table = np.zeros(len(frames), dtype=FRAME_DTYPE)
+        offset = 0
+        for i, (stamp, stage, particles) in enumerate(frames):
+            table[i] = (stamp, stage, len(particles), offset)
+            offset += len(particles)
+        header = np.zeros(1, dtype=CHUNK_HEADER)
+        header[0] = (CHUNK_MAGIC, len(frames), offset)
+
+        self.file.write(header.tobytes())
+        self.file.write(table.tobytes())
+        for stamp, stage, particles in frames:
+            self.file.write(particles.tobytes())
+        self.file.flush()
+
+    def close(self):
+        """ Write out whatever is still in the buffer and close the recording """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+
+class CloudHistory:
+    """ Read access to a recording made by CloudRecorder.  The file is memory mapped, the particles of a frame are
+        only read from disk once they are used.  A chunk that was cut short (e.g. the node died while writing it) is
+        ignored.
+        Attributes:
+            stamps: the stamp of every frame, in the order they were recorded
+            stages: the stage of every frame (an index into STAGES)
+    """
+
+    def __init__(self, filename):
+        data = np.memmap(filename, dtype=np.uint8, mode="r")
+        header = np.frombuffer(data[:FILE_HEADER.itemsize].tobytes(), dtype=FILE_HEADER)
+        if len(header) == 0 or header["magic"][0] != MAGIC:
+            raise ValueError("%s is not a particle cloud recording" % filename)
+        if header["version"][0] != VERSION:
+            raise ValueError("%s is a version %d recording, expected version %d" %
+                             (filename, header["version"][0], VERSION))
+
+        tables = []  # the frame table of each chunk
+        self.chunks = []  # the particle rows of each chunk
+        position = FILE_HEADER.itemsize
+        while position + CHUNK_HEADER.itemsize <= len(data):
+            chunk = data[position:position + CHUNK_HEADER.itemsize].view(CHUNK_HEADER)[0]
+            table_start = position + CHUNK_HEADER.itemsize
+            rows_start = table_start + int(chunk["n_frames"]) * FRAME_DTYPE.itemsize
+            end = rows_start + int(chunk["n_rows"]) * ROW_COLUMNS * 8
+            if chunk["magic"] != CHUNK_MAGIC or end > len(data):
+                break
+            table = data[table_start:rows_start].view(FRAME_DTYPE)
+            tables.append(table)
+            self.chunks.append(data[rows_start:end].view("<f8").reshape(-1, ROW_COLUMNS))
+            position = end
+
+        # the frame table of the whole recording, and which chunk holds the particles of each frame
+        self.frame_table = np.concatenate(tables) if tables else np.zeros(0, dtype=FRAME_DTYPE)
+        self.frame_chunks = np.repeat(np.arange(len(tables)), [len(table) for table in tables])
+        self.stamps = self.frame_table["stamp"]
+        self.stages = self.frame_table["stage"]
+
+    def __len__(self):
+        return len(self.frame_table)
+
+    def __getitem__(self, i):
+        """ Returns frame i as a tuple (stamp, stage name, n x 5 array of x, y, theta, weight, multiplicity) """
+        frame = self.frame_table[i]
+        offset = int(frame["offset"])
+        particles = self.chunks[self.frame_chunks[i]][offset:offset + int(frame["count"])]
+        return float(frame["stamp"]), STAGES[frame["stage"]], particles
+
+    def frames(self, stage=None):
+        """ Iterate over the frames (see __getitem__), only those of one stage if stage is given """
+        for i in range(len(self)):
+            if stage is None or self.stages[i] == STAGES.index(stage):
+                yield self[i]
+
+    def updates(self):
+        """ Group the frames by the scan they belong to, returns a list of (stamp, {stage name: particles}) """
+        updates = []
+        for stamp, stage, particles in self.frames():
+            if not updates or updates[-1][0] != stamp or stage in updates[-1][1]:
+                updates.append((stamp, {}))
+            updates[-1][1][stage] = particles
+        return updates
@@ -0,0 +1,60 @@
+""" Loads map_server style maps (a YAML file pointing at a PNG/PGM image) straight into numpy, so that the particle
+    filter can build its OccupancyField without a running map_server (benchmarks, bagfile replay...) """
+import os
+
+import yaml
+import numpy as np
+from PIL import Image
+
+from geometry_msgs.msg import Pose, Point, Quaternion
+from nav_msgs.msg import MapMetaData
+from tf.transformations import quaternion_from_euler
+
+# values used in nav_msgs/OccupancyGrid
+OCCUPIED = 100
+FREE = 0
+UNKNOWN = -1
+
+
+def load_map(yaml_file):
+    """ Load the map described by yaml_file (see http://wiki.ros.org/map_server for the format).
+        Returns a tuple (grid, info) where grid is a height x width numpy int8 array of occupancy values laid out
+        like nav_msgs/OccupancyGrid data (row 0 is the bottom of the image) and info is the nav_msgs/MapMetaData """
+    with open(yaml_file) as f:
+        description = yaml.safe_load(f)
+
+    image_file = description['image']
+    if not os.path.isabs(image_file):
+        image_file = os.path.join(os.path.dirname(yaml_file), image_file)
+    grid = image_to_occupancy(np.asarray(Image.open(image_file)),
+                              description.get('negate', 0),
+                              description['occupied_thresh'],
+                              description['free_thresh'])
+
+    origin = description['origin']
+    orientation = quaternion_from_euler(0, 0, origin[2])
+    info = MapMetaData(resolution=description['resolution'],
+                       width=grid.shape[1],
+                       height=grid.shape[0],
+                       origin=Pose(position=Point(x=origin[0], y=origin[1], z=0),
+                                   orientation=Quaternion(x=orientation[0], y=orientation[1], z=orientation[2],
+                                                          w=orientation[3])))
+    return grid, info
+
+
+def image_to_occupancy(pixels, negate, occupied_thresh, free_thresh):
+    """ Convert image pixels to occupancy values the same way map_server does in trinary mode: the color channels are
+        averaged (alpha is ignored), turned into an occupancy probability (dark is occupied unless negate is set) and
+        thresholded into OCCUPIED, FREE or UNKNOWN.  Returns the grid flipped so that row 0 is the bottom row. """
+    pixels = pixels.astype(float)
+    if pixels.ndim == 3:
+        # drop the alpha channel, if there is one
+        channels = pixels.shape[2] if pixels.shape[2] in (1, 3) else pixels.shape[2] - 1
+        pixels = pixels[:, :, :channels].mean(axis=2)
+
+    occupancy = pixels / 255.0 if negate else (255.0 - pixels) / 255.0
+    grid = np.empty(occupancy.shape, dtype=np.int8)
+    grid.fill(UNKNOWN)
+    grid[occupancy > occupied_thresh] = OCCUPIED
+    grid[occupancy < free_thresh] = FREE
+    return grid[::-1]
@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+""" Runs several particle filters in a single node.  The namespaces of the filters are read from the ~filters
+    parameter, the parameters of each filter live under ~<namespace>/ (see ParticleFilter.get_param) """
+import rospy
+
+from pf_level2 import ParticleFilterHost
+
+if __name__ == '__main__':
+    rospy.init_node('pf_host')
+    host = ParticleFilterHost(rospy.get_param('~filters', ['robot1']), rospy.get_param('~batch_window', 0.005),
+                              rospy.get_param('~map_file', ''), rospy.get_param('~map_topic', 'map'))
+    r = rospy.Rate(5)
+
+    while not (rospy.is_shutdown()):
+        # in the main loop all we do is continuously broadcast the latest map to odom transforms
+        host.broadcast_last_transforms()
+        r.sleep()
@@ -3,10 +3,13 @@ from copy import deepcopy
 
 import rospy
 
-from std_msgs.msg import Header, String
+from std_msgs.msg import Header, String, Float32
 from sensor_msgs.msg import LaserScan
 from geometry_msgs.msg import PoseStamped, PoseWithCovarianceStamped, PoseArray, Pose, Point, Quaternion
+from nav_msgs.msg import OccupancyGrid
 from nav_msgs.srv import GetMap
+from map_msgs.msg import OccupancyGridUpdate
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 
 import tf
 from tf import TransformListener
@@ -14,8 +17,11 @@ from tf import TransformBroadcaster
 from tf.transformations import euler_from_quaternion, rotation_matrix, quaternion_from_matrix
 from random import gauss
 
+import os
 import math
 import time
+import hashlib
+import threading
 
 import numpy as np
 from scipy.stats import norm
@@ -23,6 +29,11 @@ from numpy.random import random_sample
 from sklearn.neighbors import NearestNeighbors
 import matplotlib.pyplot as plt 
 
+from map_loader import load_map
+from checkpoint import FilterCheckpoint, CheckpointWriter
+from cloud_recorder import CloudRecorder
+from update_profiler import UpdateProfiler
+
 def normal(x, sigma, mu=0.0):
     """
     See equation at http://en.wikipedia.org/wiki/Normal_distribution
@@ -32,6 +43,34 @@ def normal(x, sigma, mu=0.0):
     return multiple * math.e**power
 
 
+def beam_endpoints(poses, beam_angles, beam_ranges):
+    """ Project every beam of a scan from every pose into the map frame.
+        poses: an n x 3 numpy array of x, y, theta
+        beam_angles: the angle of each beam relative to the robot (numpy.ndarray of length b)
+        beam_ranges: the measured range of each beam (numpy.ndarray of length b)
+        Returns two n x b arrays holding the x and y coordinates of the beam endpoints """
+    angles = poses[:, 2:3] + beam_angles
+    xs = np.cos(angles) * beam_ranges + poses[:, 0:1]
+    ys = np.sin(angles) * beam_ranges + poses[:, 1:2]
+    return xs, ys
+
+
+def subsample_beams(beam_angles, beam_ranges, max_beams):
+    """ Keep at most max_beams (evenly spread) of the beams of a scan, 0 keeps all of them """
+    if max_beams and len(beam_ranges) > max_beams:
+        keep = np.unique(np.linspace(0, len(beam_ranges) - 1, max_beams).astype(int))
+        return beam_angles[keep], beam_ranges[keep]
+    return beam_angles, beam_ranges
+
+
+def log_beam_likelihoods(distances, sigma, max_distance):
+    """ The log likelihood of each beam in the likelihood field model given the distance from its endpoint to the
+        closest obstacle.  Distances are capped at max_distance, and endpoints that fall off the map (nan) are
+        treated as being max_distance away from everything. """
+    distances = np.where(np.isnan(distances), max_distance, np.minimum(distances, max_distance))
+    return np.log1p(normal(distances, sigma))  # the 1+ is hacky
+
+
 class TransformHelpers:
     """ Some convenience functions for translating between various
         representions of a robot pose.
@@ -85,19 +124,23 @@ class Particle:
             theta: the yaw of the hypothesis relative to the map frame
             w: the particle weight (the class does not ensure that particle
                 weights are normalized
+            m: the multiplicity of the particle, i.e. how many identical copies
+                of it are in the cloud (each with weight w)
     """
 
-    def __init__(self, x=0.0, y=0.0, theta=0.0, w=1.0):
+    def __init__(self, x=0.0, y=0.0, theta=0.0, w=1.0, m=1):
         """ Construct a new Particle
             x: the x-coordinate of the hypothesis relative to the map frame
             y: the y-coordinate of the hypothesis relative ot the map frame
             theta: the yaw of the hypothesis relative to the map frame
             w: the particle weight (the class does not ensure that particle
-                weights are normalized """
+                weights are normalized
+            m: the number of identical copies this particle stands for """
         self.x = x
         self.y = y
         self.theta = theta
         self.w = w
+        self.m = m
 
     def as_pose(self):
         """ A helper function to convert a particle to a geometry_msgs/Pose
@@ -117,149 +160,827 @@ class OccupancyField:
     """ Stores an occupancy field for an input map.  An occupancy field returns the distance to the closest
         obstacle for any coordinate in the map
         Attributes:
-            map: the map to localize against (nav_msgs/OccupancyGrid)
-            closest_occupied: the distance for each entry in the OccupancyGrid to the closest obstacle
+            info: the metadata (size, resolution and origin) of the map to localize against (nav_msgs/MapMetaData)
+            grid: the occupancy values of the map as a height x width numpy array (row major like
+                  nav_msgs/OccupancyGrid, indexed [y, x])
+            distance_grid: the distance from each cell of the map to the closest obstacle, stored as a
+                           height x width numpy array (indexed [y, x])
+            gradient_x, gradient_y: the gradient of distance_grid (in meters per meter) along x and y, same layout
     """
 
-    def __init__(self, map):
-        self.map = map  # save this for later
-        # build up a numpy array of the coordinates of each grid cell in the map
-        cell_coordinates = np.zeros((self.map.info.width * self.map.info.height, 2))
-
-        # while we're at it let's count the number of occupied cells
-        total_occupied = 0
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                # occupancy grids are stored in row major order, if you go through this right, you might be able to use curr
-                ind = i + j * self.map.info.width
-                if self.map.data[ind] > 0:
-                    total_occupied += 1
-                cell_coordinates[curr, 0] = float(i)
-                cell_coordinates[curr, 1] = float(j)
-                curr += 1
-
-        # build up a numpy array of the coordinates of each occupied grid cell in the map
-        occupied_cell_coordinates = np.zeros((total_occupied, 2))
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                # occupancy grids are stored in row major order, if you go through this right, you might be able to use curr
-                ind = i + j * self.map.info.width
-                if self.map.data[ind] > 0:
-                    occupied_cell_coordinates[curr, 0] = float(i)
-                    occupied_cell_coordinates[curr, 1] = float(j)
-                    curr += 1
-        # self.occupied_cell_coordinates = occupied_cell_coordinates
+    def __init__(self, grid, info, distance_grid=None):
+        """ Build the occupancy field from grid (see the attributes above) and the map metadata info.  Use
+            from_occupancy_grid for a nav_msgs/OccupancyGrid or map_loader.load_map for a map_server YAML file.
+            An OccupancyField is never modified once built (see patched), so it can be swapped under a running
+            filter without any locking. """
+        self.info = info  # save this for later
+        self.grid = grid
+        self.hash = None  # computed on demand by fingerprint
+
+        if distance_grid is None:
+            rows, columns = np.indices(self.grid.shape)
+            distance_grid = OccupancyField.compute_distances(self.grid, rows.ravel(), columns.ravel(),
+                                                             self.info.resolution).reshape(self.grid.shape)
+        self.distance_grid = distance_grid
+        # the gradient points away from the closest obstacle, it's what scan matching follows
+        self.gradient_y, self.gradient_x = np.gradient(self.distance_grid, self.info.resolution)
+
+    @staticmethod
+    def compute_distances(grid, rows, columns, resolution):
+        """ Returns the distance (in meters) from each of the cells (rows[i], columns[i]) to the closest occupied
+            cell of grid """
+        # build up numpy arrays of the coordinates of the cells we want and of each occupied grid cell in the map
+        cell_coordinates = np.column_stack((columns, rows)).astype(float)
+        occupied_rows, occupied_columns = np.nonzero(grid > 0)
+        occupied_cell_coordinates = np.column_stack((occupied_columns, occupied_rows)).astype(float)
 
         # use super fast scikit learn nearest neighbor algorithm
         neighbors = NearestNeighbors(n_neighbors=1, algorithm="ball_tree").fit(occupied_cell_coordinates)
         distances, indices = neighbors.kneighbors(cell_coordinates)
+        return distances[:, 0] * resolution
+
+    def fingerprint(self):
+        """ A hash of the map (occupancy values and geometry), used to make sure a checkpoint belongs to this map """
+        if self.hash is None:
+            digest = hashlib.sha1(np.ascontiguousarray(self.grid, dtype=np.int8).tobytes())
+            digest.update(repr((self.info.width, self.info.height, self.info.resolution,
+                                self.info.origin.position.x, self.info.origin.position.y)).encode())
+            self.hash = digest.hexdigest()
+        return self.hash
+
+    def same_geometry(self, info):
+        """ Whether info (nav_msgs/MapMetaData) describes a map with the same size, resolution and origin as ours """
+        return (info.width == self.info.width and info.height == self.info.height and
+                info.resolution == self.info.resolution and
+                info.origin.position.x == self.info.origin.position.x and
+                info.origin.position.y == self.info.origin.position.y)
+
+    def patched(self, x, y, patch):
+        """ Returns a new OccupancyField for the map with the block starting at cell (x, y) replaced by patch (a
+            numpy array of occupancy values, indexed [y, x]).  Only the distances that can change are recomputed:
+            a cell's closest obstacle can only move if the old or the new one lies in the region whose occupancy
+            changed, and either way the cell is then no further from that region than from its old closest
+            obstacle. """
+        # clip the patch to the map
+        patch = patch[max(0, -y):self.info.height - y, max(0, -x):self.info.width - x]
+        x, y = max(0, x), max(0, y)
+        height, width = patch.shape
+
+        grid = self.grid.copy()
+        grid[y:y + height, x:x + width] = patch
+
+        # find the region where cells actually became (un)occupied, nothing else affects the distances
+        flipped_rows, flipped_columns = np.nonzero((self.grid[y:y + height, x:x + width] > 0) != (patch > 0))
+        if len(flipped_rows) == 0:
+            return OccupancyField(grid, self.info, self.distance_grid)
+        x0, x1 = x + flipped_columns.min(), x + flipped_columns.max()
+        y0, y1 = y + flipped_rows.min(), y + flipped_rows.max()
+
+        # the band of cells that are at most their old obstacle distance away from the region
+        rows, columns = np.indices(grid.shape)
+        dx = np.maximum(np.maximum(x0 - columns, columns - x1), 0)
+        dy = np.maximum(np.maximum(y0 - rows, rows - y1), 0)
+        band_rows, band_columns = np.nonzero(np.hypot(dx, dy) * self.info.resolution <= self.distance_grid + 1e-9)
+
+        distance_grid = self.distance_grid.copy()
+        distance_grid[band_rows, band_columns] = OccupancyField.compute_distances(grid, band_rows, band_columns,
+                                                                                  self.info.resolution)
+        return OccupancyField(grid, self.info, distance_grid)
 
-        self.closest_occupied = {}
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                ind = i + j * self.map.info.width
-                self.closest_occupied[ind] = distances[curr][0] * self.map.info.resolution
-                curr += 1
+    @staticmethod
+    def from_occupancy_grid(map):
+        """ Build an occupancy field for a nav_msgs/OccupancyGrid (e.g. the map returned by the static_map service) """
+        grid = np.asarray(map.data, dtype=np.int8).reshape(map.info.height, map.info.width)
+        return OccupancyField(grid, map.info)
 
     def get_closest_obstacle_distance(self, x, y):
         """ Compute the closest obstacle to the specified (x,y) coordinate in the map.  If the (x,y) coordinate
             is out of the map boundaries, nan will be returned. """
-        x_coord = int((x - self.map.info.origin.position.x) / self.map.info.resolution)
-        y_coord = int((y - self.map.info.origin.position.y) / self.map.info.resolution)
+        x_coord = int((x - self.info.origin.position.x) / self.info.resolution)
+        y_coord = int((y - self.info.origin.position.y) / self.info.resolution)
 
         # check if we are in bounds
-        if x_coord > self.map.info.width or x_coord < 0:
+        if x_coord >= self.info.width or x_coord < 0:
             return float('nan')
-        if y_coord > self.map.info.height or y_coord < 0:
+        if y_coord >= self.info.height or y_coord < 0:
             return float('nan')
+        return self.distance_grid[y_coord, x_coord]
+
+    def get_closest_obstacle_distances(self, x, y):
+        """ Vectorized version of get_closest_obstacle_distance.  x and y are numpy arrays of the same shape, the
+            result has that shape too and is nan wherever the coordinate is out of the map boundaries. """
+        # astype(int) truncates towards zero just like int() does above
+        x_coord = ((x - self.info.origin.position.x) / self.info.resolution).astype(int)
+        y_coord = ((y - self.info.origin.position.y) / self.info.resolution).astype(int)
+
+        in_bounds = (x_coord >= 0) & (x_coord < self.info.width) & \
+                    (y_coord >= 0) & (y_coord < self.info.height)
+        distances = np.empty(x_coord.shape)
+        distances.fill(float('nan'))
+        distances[in_bounds] = self.distance_grid[y_coord[in_bounds], x_coord[in_bounds]]
+        return distances
+
+    def get_distances_and_gradients(self, x, y):
+        """ Bilinearly interpolated obstacle distance and its gradient at the coordinates in the numpy arrays x and y,
+            smooth enough for scan matching.  Returns three arrays (distance, d/dx, d/dy) shaped like x, which are
+            nan wherever the coordinate is out of the map boundaries. """
+        # the value of a cell is taken to be at its center
+        u = (x - self.info.origin.position.x) / self.info.resolution - 0.5
+        v = (y - self.info.origin.position.y) / self.info.resolution - 0.5
+        in_bounds = (u >= 0) & (u <= self.info.width - 1) & (v >= 0) & (v <= self.info.height - 1)
+        u, v = u[in_bounds], v[in_bounds]
+        x0 = np.minimum(np.floor(u).astype(int), self.info.width - 2)
+        y0 = np.minimum(np.floor(v).astype(int), self.info.height - 2)
+        fx, fy = u - x0, v - y0
+
+        results = []
+        for grid in (self.distance_grid, self.gradient_x, self.gradient_y):
+            result = np.empty(x.shape)
+            result.fill(float('nan'))
+            result[in_bounds] = (grid[y0, x0] * (1 - fx) * (1 - fy) + grid[y0, x0 + 1] * fx * (1 - fy) +
+                                 grid[y0 + 1, x0] * (1 - fx) * fy + grid[y0 + 1, x0 + 1] * fx * fy)
+            results.append(result)
+        return tuple(results)
+
+
+def score_with_early_termination(score_function, poses, beam_angles, beam_ranges, margin, n_chunks,
+                                 log_priors=None):
+    """ Score poses against a scan, giving up early on the hopeless ones.  The beams are evaluated in n_chunks
+        interleaved chunks (beams 0, n_chunks, 2*n_chunks... first) so that every chunk covers the whole scan.  After
+        each chunk, poses whose log prior plus accumulated log likelihood is more than margin below the best one stop
+        being evaluated; since no beam can lower the log likelihood, their partial score is a floor for the full one
+        and is what they get.
+            score_function: called as score_function(poses, beam_angles, beam_ranges), returns log likelihoods
+            log_priors: the log weight each pose carries into the update (None if they are all equally likely), a
+                        pose the scan agrees with less can still come out on top if it was more likely to begin with
+        Returns the log likelihood of each pose (without the prior) and the number of beam evaluations that were
+        skipped """
+    if log_priors is None:
+        log_priors = np.zeros(len(poses))
+    log_likelihoods = np.zeros(len(poses))
+    active = np.arange(len(poses))
+    n_evaluated = 0
+    for chunk in range(n_chunks):
+        ranges = beam_ranges[chunk::n_chunks]
+        if len(active) == 0 or len(ranges) == 0:
+            continue
+        log_likelihoods[active] += score_function(poses[active], beam_angles[chunk::n_chunks], ranges)
+        n_evaluated += len(active) * len(ranges)
+        log_posteriors = log_priors[active] + log_likelihoods[active]
+        active = active[log_posteriors >= np.max(log_posteriors) - margin]
+    return log_likelihoods, len(poses) * len(beam_ranges) - n_evaluated
+
+
+def scan_match_residuals(occupancy_field, pose, beam_angles, beam_ranges, max_distance):
+    """ The residuals (obstacle distance of each beam endpoint, capped at max_distance) of a scan taken from pose
+        (x, y, theta) and their Jacobian with respect to the pose.  Beams that are capped or off the map don't pull
+        on the pose, their rows of the Jacobian are zero.
+        Returns (residuals, jacobian) with shapes (b,) and (b, 3) """
+    angles = pose[2] + beam_angles
+    xs = np.cos(angles) * beam_ranges + pose[0]
+    ys = np.sin(angles) * beam_ranges + pose[1]
+    distances, gradient_x, gradient_y = occupancy_field.get_distances_and_gradients(xs, ys)
+
+    inliers = ~np.isnan(distances) & (distances < max_distance)
+    residuals = np.where(inliers, distances, max_distance)
+    jacobian = np.zeros((len(beam_ranges), 3))
+    jacobian[inliers, 0] = gradient_x[inliers]
+    jacobian[inliers, 1] = gradient_y[inliers]
+    # moving theta swings each endpoint around the robot
+    jacobian[inliers, 2] = gradient_x[inliers] * (pose[1] - ys[inliers]) + gradient_y[inliers] * (xs[inliers] - pose[0])
+    return residuals, jacobian
+
+
+def refine_pose(occupancy_field, pose, beam_angles, beam_ranges, iterations, max_distance):
+    """ Scan matching: a few Gauss-Newton iterations that move pose (x, y, theta) so that the beam endpoints line up
+        with the obstacles in the occupancy field (minimizing the sum of squared endpoint distances).  A step is only
+        taken if it lowers that sum.
+        Returns the refined pose (numpy array) and the final sum of squared residuals """
+    pose = np.array(pose, dtype=float)
+    residuals, jacobian = scan_match_residuals(occupancy_field, pose, beam_angles, beam_ranges, max_distance)
+    cost = np.dot(residuals, residuals)
+    for i in range(iterations):
+        step = np.linalg.lstsq(jacobian, -residuals, rcond=-1)[0]
+        new_pose = pose + step
+        new_residuals, new_jacobian = scan_match_residuals(occupancy_field, new_pose, beam_angles, beam_ranges,
+                                                           max_distance)
+        new_cost = np.dot(new_residuals, new_residuals)
+        if new_cost >= cost:
+            break
+        pose, residuals, jacobian, cost = new_pose, new_residuals, new_jacobian, new_cost
+    return pose, cost
+
+
+def load_occupancy_field(map_file=""):
+    """ Build the OccupancyField to localize against.  The map is read directly from map_file (a map_server YAML
+        file) if one is given, otherwise it is requested from the map server """
+    if map_file:
+        return OccupancyField(*load_map(map_file))
+    # request the map from the map server, the map should be of type nav_msgs/OccupancyGrid
+    get_static_map = rospy.ServiceProxy('static_map', GetMap)
+    return OccupancyField.from_occupancy_grid(get_static_map().map)
+
+
+class OccupancyFieldUpdater:
+    """ Keeps the occupancy field of a BatchScorer in sync with a changing map.  Listens to full map republishes
+        (e.g. the latched map topic of map_server) and to partial nav_msgs/OccupancyGridUpdate patches, recomputes
+        the distances that can have changed and then swaps the new OccupancyField into the scorer, so laser
+        updates keep running against the old field in the meantime.
+        Attributes:
+            scorer: the BatchScorer whose occupancy field we keep up to date
+            lock: makes sure updates coming in on the two topics are applied one after the other
+            map_subscriber: listens for full maps on the map topic
+            update_subscriber: listens for partial map updates on <map topic>_updates
+    """
 
-        ind = x_coord + y_coord * self.map.info.width
-        if ind >= self.map.info.width * self.map.info.height or ind < 0:
-            return float('nan')
-        return self.closest_occupied[ind]
+    def __init__(self, scorer, map_topic="map"):
+        self.scorer = scorer
+        self.lock = threading.Lock()
+        self.map_subscriber = rospy.Subscriber(map_topic, OccupancyGrid, self.map_received)
+        self.update_subscriber = rospy.Subscriber(map_topic + "_updates", OccupancyGridUpdate,
+                                                  self.map_update_received)
+
+    def map_received(self, msg):
+        """ Callback for a full map.  If the map has the same geometry as the current one only the region that
+            changed is recomputed, otherwise the field is rebuilt from scratch """
+        grid = np.asarray(msg.data, dtype=np.int8).reshape(msg.info.height, msg.info.width)
+        with self.lock:
+            field = self.scorer.occupancy_field
+            if not field.same_geometry(msg.info):
+                rospy.loginfo("map geometry changed, rebuilding the occupancy field")
+                self.scorer.occupancy_field = OccupancyField(grid, msg.info)
+                return
+
+            changed_rows, changed_columns = np.nonzero(grid != field.grid)
+            if len(changed_rows) == 0:
+                return
+            x0, x1 = changed_columns.min(), changed_columns.max() + 1
+            y0, y1 = changed_rows.min(), changed_rows.max() + 1
+            self.apply_patch(x0, y0, grid[y0:y1, x0:x1])
+
+    def map_update_received(self, msg):
+        """ Callback for a partial map update """
+        patch = np.asarray(msg.data, dtype=np.int8).reshape(msg.height, msg.width)
+        with self.lock:
+            self.apply_patch(msg.x, msg.y, patch)
+
+    def apply_patch(self, x, y, patch):
+        """ Recompute the occupancy field with patch applied at cell (x, y) and swap it in """
+        start = time.time()
+        self.scorer.occupancy_field = self.scorer.occupancy_field.patched(x, y, patch)
+        rospy.loginfo("applied %dx%d map update at (%d, %d) in %.3fs", patch.shape[1], patch.shape[0], x, y,
+                      time.time() - start)
+
+
+class ScoreRequest:
+    """ A single particle cloud waiting to be scored by a BatchScorer
+        Attributes:
+            poses: an n x 3 numpy array of particle x, y, theta
+            beam_angles: the angle of each valid beam relative to the robot
+            beam_ranges: the range of each valid beam
+            sigma: the standard deviation of the likelihood field model
+            max_distance: the largest obstacle distance to take into account
+            log_likelihoods: the result, one log likelihood per pose
+            error: the exception raised while scoring the batch (if any)
+            done: set once the batch containing this request has been scored
+    """
+
+    def __init__(self, poses, beam_angles, beam_ranges, sigma, max_distance):
+        self.poses = poses
+        self.beam_angles = beam_angles
+        self.beam_ranges = beam_ranges
+        self.sigma = sigma
+        self.max_distance = max_distance
+        self.log_likelihoods = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchScorer:
+    """ Scores particle clouds against an occupancy field with the likelihood field model.  Clouds that are
+        submitted within batch_window seconds of each other (e.g. by several filters whose scans arrive together)
+        are scored with a single vectorized map lookup.
+        Attributes:
+            occupancy_field: the OccupancyField to score against (shared by every filter using this scorer and
+                             replaced by an OccupancyFieldUpdater when the map changes)
+            batch_window: how long the first request of a batch waits for others to join it (0 scores right away)
+            pending: the requests that have not been picked up by a batch yet
+    """
+
+    def __init__(self, occupancy_field, batch_window=0.0):
+        self.occupancy_field = occupancy_field
+        self.batch_window = batch_window
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def score(self, poses, beam_angles, beam_ranges, sigma, max_distance, wait=True):
+        """ Returns the log likelihood of the scan (beam_angles, beam_ranges) for each row of poses.  Blocks until
+            the batch this request ends up in has been scored.
+                wait: if this request starts a batch, wait batch_window for others to join it.  Follow-up requests
+                      of an update (e.g. the chunks of early termination) pass False, they only pick up whoever
+                      happens to be pending """
+        request = ScoreRequest(poses, beam_angles, beam_ranges, sigma, max_distance)
+        with self.lock:
+            self.pending.append(request)
+            leader = len(self.pending) == 1
+
+        if leader:
+            # the first request of a batch waits for the others and then scores all of them
+            if self.batch_window > 0 and wait:
+                time.sleep(self.batch_window)
+            with self.lock:
+                batch, self.pending = self.pending, []
+            try:
+                self.score_batch(batch)
+            except Exception as e:
+                for r in batch:
+                    r.error = e
+            for r in batch:
+                r.done.set()
+        else:
+            request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+        return request.log_likelihoods
+
+    def score_batch(self, batch):
+        """ Score every request in batch with one lookup in the occupancy field """
+        xs, ys, sigmas, max_distances = [], [], [], []
+        for r in batch:
+            x, y = beam_endpoints(r.poses, r.beam_angles, r.beam_ranges)
+            xs.append(x.ravel())
+            ys.append(y.ravel())
+            sigmas.append(np.repeat(r.sigma, x.size))
+            max_distances.append(np.repeat(r.max_distance, x.size))
+
+        distances = self.occupancy_field.get_closest_obstacle_distances(np.concatenate(xs), np.concatenate(ys))
+        beam_log_likelihoods = log_beam_likelihoods(distances, np.concatenate(sigmas), np.concatenate(max_distances))
+
+        # split the result back up, each particle's log likelihood is the sum over its beams
+        start = 0
+        for r, x in zip(batch, xs):
+            r.log_likelihoods = beam_log_likelihoods[start:start + x.size].reshape(len(r.poses),
+                                                                                  len(r.beam_ranges)).sum(axis=1)
+            start += x.size
+
+
+class LikelihoodCache:
+    """ Memoizes particle log likelihoods for one scan.  Poses are quantized into (x, y, theta) bins and all of the
+        particles in a bin share the likelihood of the first one scored, which pays off after resampling when
+        much of the cloud consists of copies of a few particles.  The entries are dropped as soon as a new scan
+        comes in.
+        Attributes:
+            xy_resolution: the size (in meters) of the x and y bins
+            theta_resolution: the size (in radians) of the theta bins
+            max_entries: the most bins remembered for a scan, particles in bins beyond that aren't cached
+            scan_stamp: the time stamp of the scan the entries belong to
+            entries: maps a quantized pose (tuple of three ints) to its log likelihood
+            lookups: the number of particles scored through the cache
+            hits: the number of those particles that didn't need their own likelihood evaluation
+    """
+
+    def __init__(self, xy_resolution, theta_resolution, max_entries=10000):
+        self.xy_resolution = xy_resolution
+        self.theta_resolution = theta_resolution
+        self.max_entries = max_entries
+        self.scan_stamp = None
+        self.entries = {}
+        self.lookups = 0
+        self.hits = 0
+
+    def hit_rate(self):
+        """ The fraction of lookups that were answered without an evaluation of their own """
+        return float(self.hits) / self.lookups if self.lookups else 0.0
+
+    def score(self, scan_stamp, poses, score_function, log_priors=None):
+        """ Returns the log likelihood of each row of poses (an n x 3 numpy array of x, y, theta) for the scan taken
+            at scan_stamp.  score_function is called as score_function(poses, log_priors) with the poses that are not
+            in the cache yet and has to return their log likelihoods.
+                log_priors: the log weight of each pose (or None), handed to score_function as the best log weight
+                            among the poses that share a bin """
+        if scan_stamp != self.scan_stamp:
+            self.entries = {}
+            self.scan_stamp = scan_stamp
+
+        keys = np.column_stack((np.floor(poses[:, 0] / self.xy_resolution),
+                                np.floor(poses[:, 1] / self.xy_resolution),
+                                np.floor((poses[:, 2] % (2 * math.pi)) / self.theta_resolution))).astype(int)
+        unique_keys, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+
+        log_likelihoods = np.empty(len(unique_keys))
+        missing = []
+        for i, key in enumerate(map(tuple, unique_keys)):
+            if key in self.entries:
+                log_likelihoods[i] = self.entries[key]
+            else:
+                missing.append(i)
+        if missing:
+            bin_priors = None
+            if log_priors is not None:
+                bin_priors = np.full(len(unique_keys), -np.inf)
+                np.maximum.at(bin_priors, inverse.ravel(), log_priors)
+                bin_priors = bin_priors[missing]
+            log_likelihoods[missing] = score_function(poses[first[missing]], bin_priors)
+            for i in missing:
+                if len(self.entries) >= self.max_entries:
+                    break
+                self.entries[tuple(unique_keys[i])] = log_likelihoods[i]
+
+        self.lookups += len(poses)
+        self.hits += len(poses) - len(missing)
+        return log_likelihoods[inverse.ravel()]
+
+
+class UpdateScheduler:
+    """ Keeps filter updates within a latency budget.  The cost of recent updates is tracked (as the time per beam
+        evaluation of the laser update and the time per particle of everything else) and used to pick the number of
+        beams and particles of the next update, or to skip its laser correction altogether when even the smallest
+        update would not fit.  The budget is either fixed or follows the measured scan period.
+        Attributes:
+            update_budget: the latency budget of an update in seconds (0 follows the scan period)
+            max_beams: the number of beams to use when there is time (0 for all of them)
+            min_beams: the fewest beams a laser update is allowed to use
+            max_particles: the number of particles to use when there is time
+            min_particles: the fewest particles the cloud is allowed to shrink to
+            max_skipped: the most laser corrections that can be skipped in a row
+            smoothing: the weight of the newest measurement in the running averages below
+            scan_period: running average of the time between scans (None until two scans have been seen)
+            laser_cost: running average of the laser update time per beam evaluation (None until measured)
+            particle_cost: running average of the time per particle spent in the rest of the update
+            full_beams: the number of beams the next update would use if there was time
+            n_beams: the number of beams planned for the next update
+            n_particles: the number of particles planned for the next update
+            run_laser: whether the next update runs its laser correction
+            n_skipped: the number of laser corrections skipped in a row
+            last_update_time: how long the last update took
+    """
+
+    def __init__(self, max_particles, update_budget=0.0, max_beams=0, min_beams=30, min_particles=10, max_skipped=3,
+                 smoothing=0.2):
+        self.update_budget = update_budget
+        self.max_beams = max_beams
+        self.min_beams = min_beams
+        self.max_particles = max_particles
+        self.min_particles = min_particles
+        self.max_skipped = max_skipped
+        self.smoothing = smoothing
+
+        self.scan_period = None
+        self.last_scan_stamp = None
+        self.laser_cost = None
+        self.particle_cost = None
+
+        self.full_beams = max_beams
+        self.n_beams = max_beams
+        self.n_particles = max_particles
+        self.run_laser = True
+        self.n_skipped = 0
+        self.last_update_time = 0.0
+
+    def average(self, average, value):
+        """ Fold value into the running average (which is None if there is no measurement yet) """
+        if average is None:
+            return value
+        return (1 - self.smoothing) * average + self.smoothing * value
+
+    def scan_received(self, stamp):
+        """ Keep track of the scan period, stamp is the time stamp of a new scan (rospy.Time) """
+        stamp = stamp.to_sec()
+        if self.last_scan_stamp is not None and stamp > self.last_scan_stamp:
+            self.scan_period = self.average(self.scan_period, stamp - self.last_scan_stamp)
+        self.last_scan_stamp = stamp
+
+    def budget(self):
+        """ The time an update may take (None if there is no budget yet) """
+        return self.update_budget or self.scan_period
+
+    def predicted_cost(self, n_beams, n_particles):
+        """ How long we expect an update with n_beams beams and n_particles particles to take """
+        return self.laser_cost * n_beams * n_particles + self.particle_cost * n_particles
+
+    def plan(self, n_available_beams):
+        """ Decide on the size of the next update, given that the scan has n_available_beams beams.
+            Beams are shed first, then particles, and if even the smallest update doesn't fit the laser correction
+            is skipped (at most max_skipped times in a row, so that we keep measuring its cost).
+            Returns (n_beams, n_particles, run_laser) """
+        budget = self.budget()
+        self.full_beams = min(self.max_beams or n_available_beams, n_available_beams)
+        self.n_beams = self.full_beams
+        self.n_particles = self.max_particles
+        self.run_laser = True
+
+        if budget is not None and self.laser_cost is not None and \
+                self.predicted_cost(self.n_beams, self.n_particles) > budget:
+            # use as many beams as fit in the budget with all of the particles
+            n_beams = int((budget / self.n_particles - self.particle_cost) / self.laser_cost)
+            self.n_beams = min(max(n_beams, self.min_beams), self.n_beams)
+            if n_beams < self.min_beams:
+                # still too slow, use as many particles as fit with the fewest beams
+                n_particles = int(budget / (self.laser_cost * self.n_beams + self.particle_cost))
+                self.n_particles = min(max(n_particles, self.min_particles), self.max_particles)
+                if n_particles < self.min_particles and self.n_skipped < self.max_skipped:
+                    self.run_laser = False
+
+        if self.run_laser:
+            self.n_skipped = 0
+        else:
+            self.n_skipped += 1
+        return self.n_beams, self.n_particles, self.run_laser
+
+    def record(self, update_time, laser_time, n_evaluations, n_particles):
+        """ Record the cost of an update that took update_time seconds in total, laser_time of which were spent
+            evaluating n_evaluations beams (beams times particles) in the laser update, with n_particles particles """
+        self.last_update_time = update_time
+        if n_evaluations > 0:
+            self.laser_cost = self.average(self.laser_cost, laser_time / n_evaluations)
+        if n_particles > 0:
+            self.particle_cost = self.average(self.particle_cost, (update_time - laser_time) / n_particles)
+
+    def diagnostics(self, name):
+        """ Returns a diagnostic_msgs/DiagnosticStatus describing the last decision of the scheduler """
+        degraded = not self.run_laser or self.n_particles < self.max_particles or self.n_beams < self.full_beams
+        if not self.run_laser:
+            message = "laser correction skipped"
+        elif degraded:
+            message = "update reduced to fit the budget"
+        else:
+            message = "full update"
+        budget = self.budget()
+        values = [("budget", budget), ("last update time", self.last_update_time), ("beams", self.n_beams),
+                  ("particles", self.n_particles), ("laser correction", self.run_laser),
+                  ("skipped in a row", self.n_skipped), ("scan period", self.scan_period)]
+        return DiagnosticStatus(level=DiagnosticStatus.WARN if degraded else DiagnosticStatus.OK, name=name,
+                                message=message, hardware_id="",
+                                values=[KeyValue(key=key, value=str(value)) for key, value in values])
+
+
+class NullPublisher:
+    """ Stands in for a rospy.Publisher when a filter runs headless (e.g. over a bagfile), drops every message """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def publish(self, msg):
+        pass
+
+    def get_num_connections(self):
+        return 0
 
 
 class ParticleFilter:
     """ The class that represents a Particle Filter ROS Node
         Attributes list:
             initialized: a Boolean flag to communicate to other class methods that initializaiton is complete
+            namespace: the prefix for the topics, frames and parameters of this filter ("" for a standalone node)
             base_frame: the name of the robot base coordinate frame (should be "base_link" for most robots)
             map_frame: the name of the map coordinate frame (should be "map" in most cases)
             odom_frame: the name of the odometry coordinate frame (should be "odom" in most cases)
             scan_topic: the name of the scan topic to listen to (should be "scan" in most cases)
             n_particles: the number of particles in the filter
+            params: the dictionary the parameters are read from (None reads them from the parameter server)
             d_thresh: the amount of linear movement before triggering a filter update
             a_thresh: the amount of angular movement before triggering a filter update
             laser_max_distance: the maximum distance to an obstacle we should use in a likelihood calculation
+            laser_sigma: the standard deviation of the likelihood field model
+            radial_sigma, orientation_sigma: the standard deviations of the motion noise (see RADIAL_SIGMA and
+                                             ORIENTATION_SIGMA for the defaults)
+            refine_iterations: the number of Gauss-Newton scan matching iterations used to refine the pose estimate
+            compact_cloud: when True, resampling keeps one particle per picked hypothesis together with the number of
+                           times it was picked (its multiplicity) instead of making a copy for every pick
+            resample_threshold: resample only when the effective sample size drops below this fraction of the number
+                                of particles (1.0 resamples on practically every update)
             pose_listener: a subscriber that listens for new approximate pose estimates (i.e. generated through the rviz GUI)
             particle_pub: a publisher for the particle cloud
+            ess_pub: a publisher for the effective sample size of the cloud after each laser update
+            diagnostics_pub: a publisher for the decisions of the update scheduler
+            scheduler: the UpdateScheduler that fits each update (beams, particles, laser or not) in its time budget
+            likelihood_cache: the LikelihoodCache shared by co-located particles (None if it is turned off)
+            early_termination_margin: how far (in log likelihood) a particle may fall behind the best one before we
+                                      stop evaluating its beams (0 evaluates every beam of every particle)
+            early_termination_chunks: the number of interleaved chunks of beams between those checks
+            n_beam_evaluations: the number of beam evaluations early termination started out with
+            n_skipped_beam_evaluations: the number of those it skipped
             laser_subscriber: listens for new scan data on topic self.scan_topic
             tf_listener: listener for coordinate transforms
             tf_broadcaster: broadcaster for coordinate transforms
             particle_cloud: a list of particles representing a probability distribution over robot poses
+                            (a particle with multiplicity m counts as m particles)
             current_odom_xy_theta: the pose of the robot in the odometry frame when the last filter update was performed.
                                    The pose is expressed as a list [x,y,theta] (where theta is the yaw)
-            map: the map we will be localizing ourselves in.  The map should be of type nav_msgs/OccupancyGrid
+            scorer: the BatchScorer that evaluates the laser likelihood of the particles, scorer.occupancy_field is
+                    the map we will be localizing ourselves in
+            map_updater: the OccupancyFieldUpdater following map changes (None when the scorer is shared by a host)
+            checkpoint_file: where the state of the filter is checkpointed ("" disables checkpoints)
+            checkpoint_period: the minimum time (in seconds) between checkpoints, 0 disables them
+            checkpoint_max_age: checkpoints older than this (in seconds) are not restored (0 for no limit)
+            checkpoint_odom_tolerance, checkpoint_odom_angle_tolerance: how far (in meters and radians) the odometry
+                                                                        may be from the restored one on the first
+                                                                        scan before the checkpoint is thrown away
+            checkpoint_unverified: True from restoring a checkpoint until the first scan has confirmed that odometry
+                                   carried on from where the checkpoint left off
+            checkpoint_writer: the CheckpointWriter that writes checkpoints in the background
+            cloud_recorder: the CloudRecorder that records every stage of the updates (None if ~record_file isn't set)
+            profiler: the UpdateProfiler that measures the updates when profiling is switched on
+            n_updates: the number of laser updates performed so far
+            n_resamples: the number of those updates that resampled the particle cloud
             robot_pose: estimated position of the robot of type geometry_msgs/Pose
     """
 
     # some constants! :) -emily and franz
     TAU = math.pi * 2.0
-    # to be used in update_particles_with_odom
+    # default motion noise (radial_sigma and orientation_sigma) used in update_particles_with_odom
     RADIAL_SIGMA = .03 # meters
     ORIENTATION_SIGMA = 0.03 * TAU
 
-    def __init__(self):
+    def __init__(self, namespace="", scorer=None, tf_listener=None, tf_broadcaster=None, params=None,
+                 headless=False):
+        """ Construct a new particle filter.  A standalone node leaves every argument at its default, a
+            ParticleFilterHost passes in the namespace of the filter and the objects it shares between its filters.
+                namespace: prefix for the topics, frames and parameters of this filter ("" for a standalone node)
+                scorer: the BatchScorer (and with it the map) used for the laser update.  If None, the map is
+                        loaded from ~map_file (or requested from the map server if that isn't set), and kept up
+                        to date with the ~map_topic topic
+                tf_listener: the TransformListener to use (a new one is created if None)
+                tf_broadcaster: the TransformBroadcaster to use (a new one is created if None)
+                params: a dictionary to read the parameters from instead of the parameter server
+                headless: run without any ROS communication (no subscribers, publishers or tf broadcaster), scans
+                          are fed to scan_received by the caller.  Needs a scorer and a tf_listener (e.g. a
+                          tf.TransformerROS filled from a bagfile) """
         self.initialized = False  # make sure we don't perform updates before everything is setup
-        rospy.init_node('pf')  # tell roscore that we are creating a new node named "pf"
+        self.namespace = namespace
+        self.params = params
+
+        self.base_frame = self.get_param("base_frame", self.resolve("base_link"))  # the frame of the robot base
+        self.map_frame = self.get_param("map_frame", "map")  # the name of the map coordinate frame
+        self.odom_frame = self.get_param("odom_frame", self.resolve("odom"))  # the name of the odometry coordinate frame
+        self.scan_topic = self.get_param("scan_topic", self.resolve("scan"))  # the topic where we will get laser scans from
 
-        self.base_frame = "base_link"  # the frame of the robot base
-        self.map_frame = "map"  # the name of the map coordinate frame
-        self.odom_frame = "odom"  # the name of the odometry coordinate frame
-        self.scan_topic = "scan"  # the topic where we will get laser scans from
+        self.n_particles = self.get_param("n_particles", 30)  # the number of particles to use
 
-        self.n_particles = 30  # the number of particles to use
+        self.d_thresh = self.get_param("d_thresh", 0.2)  # the amount of linear movement before performing an update
+        self.a_thresh = self.get_param("a_thresh", math.pi / 6)  # the amount of angular movement before performing an update
 
-        self.d_thresh = 0.2  # the amount of linear movement before performing an update
-        self.a_thresh = math.pi / 6  # the amount of angular movement before performing an update
+        self.laser_max_distance = self.get_param("laser_max_distance", 2.0)  # maximum penalty to assess in the likelihood field model
+        self.resample_threshold = self.get_param("resample_threshold", 0.5)  # resample when the ESS drops below this fraction of n_particles
+        self.compact_cloud = self.get_param("compact_cloud", False)  # store duplicate picks of a resample as one particle with a multiplicity
+        self.refine_iterations = self.get_param("refine_iterations", 5)  # Gauss-Newton scan matching iterations on the pose estimate (0 turns it off)
 
-        self.laser_max_distance = 2.0  # maximum penalty to assess in the likelihood field model
+        self.radial_sigma = self.get_param("radial_sigma", ParticleFilter.RADIAL_SIGMA)  # position noise of the motion model
+        self.orientation_sigma = self.get_param("orientation_sigma", ParticleFilter.ORIENTATION_SIGMA)  # heading noise of the motion model
+        self.laser_sigma = self.get_param("laser_sigma", 0.05)  # standard deviation of the likelihood field model
 
         # TODO: define additional constants if needed
         #set self.visualize_weights to True if you want to see a plot of xpos vs weights every time the particles are updated
-        self.visualize_weights = True 
+        # (off by default for hosted filters, matplotlib doesn't like being driven from several callback threads)
+        self.visualize_weights = self.get_param("visualize_weights", not self.namespace)
 
         # Setup pubs and subs
+        # (a headless filter gets publishers that drop everything and no subscribers)
+        Publisher = NullPublisher if headless else rospy.Publisher
 
         # pose_listener responds to selection of a new approximate robot location (for instance using rviz)
-        self.pose_listener = rospy.Subscriber("initialpose", PoseWithCovarianceStamped, self.update_initial_pose)
+        if not headless:
+            self.pose_listener = rospy.Subscriber(self.resolve("initialpose"), PoseWithCovarianceStamped,
+                                                  self.update_initial_pose)
         # publish the current particle cloud.  This enables viewing particles in rviz.
-        self.rawcloud_pub = rospy.Publisher("rawcloud", PoseArray, queue_size=1)
-        self.odomcloud_pub = rospy.Publisher("odomcloud", PoseArray, queue_size=1)
-        self.lasercloud_pub = rospy.Publisher("lasercloud", PoseArray, queue_size=1)
-        self.resamplecloud_pub = rospy.Publisher("resamplecloud", PoseArray, queue_size=1)
-        self.finalcloud_pub = rospy.Publisher("finalcloud", PoseArray, queue_size=1)
+        self.rawcloud_pub = Publisher(self.resolve("rawcloud"), PoseArray, queue_size=1)
+        self.odomcloud_pub = Publisher(self.resolve("odomcloud"), PoseArray, queue_size=1)
+        self.lasercloud_pub = Publisher(self.resolve("lasercloud"), PoseArray, queue_size=1)
+        self.resamplecloud_pub = Publisher(self.resolve("resamplecloud"), PoseArray, queue_size=1)
+        self.finalcloud_pub = Publisher(self.resolve("finalcloud"), PoseArray, queue_size=1)
+        # publish the effective sample size of the cloud after each update (to tune resample_threshold)
+        self.ess_pub = Publisher(self.resolve("ess"), Float32, queue_size=1)
+        self.diagnostics_pub = Publisher("/diagnostics", DiagnosticArray, queue_size=1)
 
         # laser_subscriber listens for data from the lidar
-        self.laser_subscriber = rospy.Subscriber(self.scan_topic, LaserScan, self.scan_received)
+        if not headless:
+            self.laser_subscriber = rospy.Subscriber(self.scan_topic, LaserScan, self.scan_received)
 
         # enable listening for and broadcasting coordinate transforms
-        self.tf_listener = TransformListener()
-        self.tf_broadcaster = TransformBroadcaster()
+        self.tf_listener = tf_listener or TransformListener()
+        self.tf_broadcaster = tf_broadcaster
+        if self.tf_broadcaster is None and not headless:
+            self.tf_broadcaster = TransformBroadcaster()
 
         self.particle_cloud = []
 
         self.current_odom_xy_theta = []
-
-        # request the map from the map server, the map should be of type nav_msgs/OccupancyGrid
-        get_static_map = rospy.ServiceProxy('static_map', GetMap)
-        self.occupancy_field = OccupancyField(get_static_map().map)
+        self.current_odom_stamp = 0.0  # the time of the scan current_odom_xy_theta was taken at
+
+        # fit updates into a time budget (~update_budget seconds, or the scan period if that is 0) by shedding
+        # beams, then particles, then the laser correction
+        self.scheduler = UpdateScheduler(self.n_particles,
+                                         update_budget=self.get_param("update_budget", 0.0),
+                                         max_beams=self.get_param("max_beams", 0),
+                                         min_beams=self.get_param("min_beams", 30),
+                                         min_particles=self.get_param("min_particles", 10),
+                                         max_skipped=self.get_param("max_skipped_corrections", 3))
+
+        # particles that share a (~likelihood_cache_xy, ~likelihood_cache_theta) bin share one likelihood
+        # evaluation, a resolution of 0 turns the cache off
+        self.likelihood_cache = None
+        if self.get_param("likelihood_cache_xy", 0.0) > 0:
+            self.likelihood_cache = LikelihoodCache(self.get_param("likelihood_cache_xy", 0.0),
+                                                    self.get_param("likelihood_cache_theta", 0.05),
+                                                    self.get_param("likelihood_cache_size", 10000))
+
+        # stop scoring particles whose log likelihood falls more than ~early_termination_margin behind the best one
+        # (checked after each of ~early_termination_chunks interleaved chunks of beams), a margin of 0 turns it off
+        self.early_termination_margin = self.get_param("early_termination_margin", 0.0)
+        self.early_termination_chunks = self.get_param("early_termination_chunks", 8)
+        self.n_beam_evaluations = 0
+        self.n_skipped_beam_evaluations = 0
+
+        # count how many of the updates actually needed a resample
+        self.n_updates = 0
+        self.n_resamples = 0
+
+        self.scorer = scorer
+        self.map_updater = None
+        if self.scorer is None:
+            self.scorer = BatchScorer(load_occupancy_field(self.get_param("map_file", "")))
+            if not headless:
+                self.map_updater = OccupancyFieldUpdater(self.scorer, self.get_param("map_topic", "map"))
         self.robot_pose = Pose()
+
+        # periodically write the state of the filter to disk, and pick up where we left off if there is a recent
+        # checkpoint for this map (so a respawned node doesn't have to re-localize)
+        ros_home = os.environ.get("ROS_HOME", os.path.join(os.path.expanduser("~"), ".ros"))
+        # (named after the node as well as the filter, so that nodes in different namespaces don't share a file)
+        checkpoint_name = (rospy.get_name() + "/" + self.resolve("checkpoint")).strip("/").replace("/", "_")
+        self.checkpoint_file = self.get_param("checkpoint_file", os.path.join(ros_home, checkpoint_name + ".npz"))
+        self.checkpoint_period = self.get_param("checkpoint_period", 0.0 if headless else 1.0)
+        self.checkpoint_max_age = self.get_param("checkpoint_max_age", 300.0)
+        # a restored checkpoint is only kept if odometry continues from where it left off (it doesn't if the
+        # odometry was restarted too, e.g. a full relaunch or a bagfile played again)
+        self.checkpoint_odom_tolerance = self.get_param("checkpoint_odom_tolerance", 0.5)
+        self.checkpoint_odom_angle_tolerance = self.get_param("checkpoint_odom_angle_tolerance", math.pi / 4)
+        self.checkpoint_unverified = False
+        self.last_checkpoint_time = 0.0
+        self.checkpoint_writer = None
+        if self.checkpoint_file and self.checkpoint_period > 0:
+            self.restore_checkpoint()
+            self.checkpoint_writer = CheckpointWriter(self.checkpoint_file)
+
+        # record every stage of every update to ~record_file ("" turns it off) for offline analysis (see
+        # cloud_recorder.CloudHistory), this is a lot cheaper than bagging the particle cloud topics
+        self.cloud_recorder = None
+        record_file = self.get_param("record_file", "")
+        if record_file:
+            self.cloud_recorder = CloudRecorder(record_file, self.get_param("record_capacity", 1000),
+                                                self.get_param("record_period", 1.0))
+            if not headless:
+                rospy.on_shutdown(self.cloud_recorder.close)
+
+        # opt-in profiling of the updates, switched on and off while running through ~profile_memory (trace the
+        # memory allocated by each stage of the update) and ~profile_updates (set it to n to write a cProfile dump of
+        # the next n updates to ~profile_prefix_<time>.prof), which are checked every ~profile_poll_period seconds
+        self.profiler = UpdateProfiler(rospy.get_name() + ("/" + self.namespace if self.namespace else ""),
+                                       self.get_param("profile_prefix",
+                                                      os.path.join(ros_home, self.resolve("pf_profile").replace("/",
+                                                                                                                "_"))),
+                                       self.get_param("profile_report_period", 30.0),
+                                       self.get_param("profile_top_sites", 10))
+        self.profile_poll_period = self.get_param("profile_poll_period", 1.0)
+        self.last_profile_poll = 0.0
         self.initialized = True
 
+    def resolve(self, name):
+        """ Prefix a topic or frame name with the namespace of this filter """
+        if not self.namespace:
+            return name
+        return self.namespace + "/" + name
+
+    def get_param(self, name, default):
+        """ Look up one of this filter's parameters, these live in the private namespace of the node
+            (i.e. ~n_particles for a standalone node, ~robot1/n_particles for the filter robot1 of a host)
+            or in the params dictionary if the filter was given one """
+        if self.params is not None:
+            return self.params.get(name, default)
+        return rospy.get_param("~" + self.resolve(name), default)
+
+    def set_param(self, name, value):
+        """ Change one of this filter's parameters (see get_param) """
+        if self.params is not None:
+            self.params[name] = value
+        else:
+            rospy.set_param("~" + self.resolve(name), value)
+
+    def poll_profiling(self):
+        """ Pick up changes to the profiling parameters, at most every profile_poll_period seconds (they live on
+            the parameter server, which is too slow to ask on every scan) """
+        now = time.time()
+        if now - self.last_profile_poll < self.profile_poll_period:
+            return
+        self.last_profile_poll = now
+        self.profiler.set_memory(bool(self.get_param("profile_memory", False)))
+        n_updates = self.get_param("profile_updates", 0)
+        if n_updates > 0:
+            self.profiler.capture(n_updates)
+            # it's a one shot, setting it again starts another capture
+            self.set_param("profile_updates", 0)
+
     def update_robot_pose(self):
         """ Update the estimate of the robot's pose given the updated particles.
             There are two logical methods for this:
@@ -275,9 +996,9 @@ class ParticleFilter:
         mean_y = 0
         mean_theta = 0
         for particle in self.particle_cloud:
-            mean_x += particle.w * particle.x
-            mean_y += particle.w * particle.y
-            mean_theta += particle.w * particle.theta
+            mean_x += particle.m * particle.w * particle.x
+            mean_y += particle.m * particle.w * particle.y
+            mean_theta += particle.m * particle.w * particle.theta
         mean_particle = Particle(mean_x, mean_y, mean_theta)
         self.robot_pose = mean_particle.as_pose()
 
@@ -300,11 +1021,15 @@ class ParticleFilter:
         delta_distance = np.linalg.norm([delta[0], delta[1]])
         r2 = delta[2] - r1
 
+        if self.radial_sigma > 0 or self.orientation_sigma > 0:
+            # the noise is about to make the copies of a particle diverge, so they need to become separate particles
+            self.expand_particles()
+
         for particle in self.particle_cloud:
             # randomly pick the deltas for radial distance, mean angle, and orientation angle
-            delta_random_radius = np.random.normal(0, ParticleFilter.RADIAL_SIGMA)
+            delta_random_radius = np.random.normal(0, self.radial_sigma)
             delta_random_mean_angle = random_sample() * ParticleFilter.TAU / 2.0
-            delta_random_orient_angle = np.random.normal(0, ParticleFilter.ORIENTATION_SIGMA)
+            delta_random_orient_angle = np.random.normal(0, self.orientation_sigma)
 
             # calculate the deltas
             delta_random_x = delta_random_radius * math.cos(delta_random_mean_angle)
@@ -323,64 +1048,166 @@ class ParticleFilter:
         # TODO: nothing unless you want to try this alternate likelihood model
         pass
 
-    def resample_particles(self):
-        """ Resample the particles according to the new particle weights """
+    def resample_particles(self, n_particles=None):
+        """ Resample the particles according to the new particle weights
+            n_particles: the size of the new cloud (defaults to self.n_particles) """
         # make sure the distribution is normalized
         self.normalize_particles()
-        probabilities = [particle.w for particle in self.particle_cloud]
+        probabilities = [particle.m * particle.w for particle in self.particle_cloud]
+
+        if self.compact_cloud:
+            # keep a single particle for every hypothesis that was picked, along with how often it was picked
+            counts = np.random.multinomial(n_particles or self.n_particles, probabilities)
+            self.particle_cloud = [Particle(particle.x, particle.y, particle.theta, 1.0, int(count))
+                                   for particle, count in zip(self.particle_cloud, counts) if count > 0]
+            self.normalize_particles()
+            return
 
         new_particle_cloud = []
-        for i in range(self.n_particles):
+        for i in range(n_particles or self.n_particles):
             random_particle = deepcopy(np.random.choice(self.particle_cloud, p=probabilities))
+            # the resampled cloud represents the distribution by its density, so every particle is equally likely
+            random_particle.w = 1.0
+            random_particle.m = 1
             new_particle_cloud.append(random_particle)
 
         self.particle_cloud = new_particle_cloud
+        self.normalize_particles()
+
+    def effective_sample_size(self):
+        """ Returns the effective sample size 1 / sum(w^2) of the particle cloud.  This goes from 1 when all of the
+            weight is on a single particle up to the number of particles when the weights are uniform """
+        self.normalize_particles()
+        return 1.0 / sum(particle.m * particle.w ** 2 for particle in self.particle_cloud)
+
+    def particle_count(self):
+        """ The number of particles in the cloud, counting every copy of a particle with a multiplicity """
+        return sum(particle.m for particle in self.particle_cloud)
 
-    def update_particles_with_laser(self, msg):
-        """ Updates the particle weights in response to the scan contained in the msg """
+    def expand_particles(self):
+        """ Replace every particle with a multiplicity by that many separate particles """
+        if all(particle.m == 1 for particle in self.particle_cloud):
+            return
+        expanded_cloud = []
+        for particle in self.particle_cloud:
+            expanded_cloud.append(particle)
+            for i in range(particle.m - 1):
+                expanded_cloud.append(Particle(particle.x, particle.y, particle.theta, particle.w))
+            particle.m = 1
+        self.particle_cloud = expanded_cloud
+
+    def update_particles_with_laser(self, msg, max_beams=0, beams=None):
+        """ Updates the particle weights in response to the scan contained in the msg
+            max_beams: use at most this many (evenly spread) beams of the scan, 0 uses all of them
+            beams: the (angles, ranges) of the valid beams of msg if the caller already has them (see laser_beams)
+            Returns the number of beams used """
 
         # compare the distance to the closest occupied location
         # of the hypothesis and laser scan measurement
         # give it a weight inversely proportional to the error
 
-        valid_ranges = self.filter_laser(msg.ranges)
-
-        for particle in self.particle_cloud:
-            total_probability_density = 1
+        beam_angles, beam_ranges = beams or self.laser_beams(msg)
+        beam_angles, beam_ranges = subsample_beams(beam_angles, beam_ranges, max_beams)
+
+        # the likelihood of a particle is the product over its beams, we get it back as a sum of logs
+        # TODO: make the total_probability_density function more legit
+        def score_beams(poses, beam_angles, beam_ranges, wait=True):
+            return self.scorer.score(poses, beam_angles, beam_ranges, self.laser_sigma, self.laser_max_distance,
+                                     wait)
+
+        def score(poses, log_priors=None):
+            return score_beams(poses, beam_angles, beam_ranges)
+
+        if self.early_termination_margin > 0:
+            def score(poses, log_priors=None):
+                # only the first chunk waits for the other filters of a host to join its batch, otherwise every
+                # chunk would sleep the batch window
+                first_chunk = [True]
+
+                def score_chunk(poses, beam_angles, beam_ranges):
+                    wait, first_chunk[0] = first_chunk[0], False
+                    return score_beams(poses, beam_angles, beam_ranges, wait)
+
+                # stop evaluating beams for particles that fall too far behind the best one
+                log_likelihoods, n_skipped = score_with_early_termination(score_chunk, poses, beam_angles,
+                                                                          beam_ranges, self.early_termination_margin,
+                                                                          self.early_termination_chunks, log_priors)
+                self.n_beam_evaluations += len(poses) * len(beam_ranges)
+                self.n_skipped_beam_evaluations += n_skipped
+                return log_likelihoods
+
+        # weights carry over between resamples, so the new weight is the old one times the scan likelihood
+        log_priors = np.log(np.maximum([particle.w for particle in self.particle_cloud], np.finfo(float).tiny))
+        # (early termination weighs the particles by their share of the distribution, multiplicity included)
+        log_shares = log_priors + np.log([particle.m for particle in self.particle_cloud])
+
+        if self.likelihood_cache is not None:
+            log_weights = self.likelihood_cache.score(msg.header.stamp, self.particle_cloud_as_array(), score,
+                                                      log_shares)
+        else:
+            log_weights = score(self.particle_cloud_as_array(), log_shares)
 
-            for angle in valid_ranges:
-                radius = valid_ranges[angle]
-                angle = (angle+.25*ParticleFilter.TAU) % ParticleFilter.TAU
-                x = math.cos(angle+particle.theta) * radius + particle.x
-                y = math.sin(angle+particle.theta) * radius + particle.y
-                dist_to_nearest_neighbor = self.occupancy_field.get_closest_obstacle_distance(x, y)
+        log_weights += log_priors
 
-                # calculate probability of nearest neighbor's distance
-                probability_density = normal(dist_to_nearest_neighbor, .05)
-                total_probability_density *= 1 + probability_density #the 1+ is hacky
-                # TODO: make the total_probability_density function more legit
+        # subtract the best score before going back from logs so that long scans don't overflow
+        weights = np.exp(log_weights - np.max(log_weights))
+        for particle, w in zip(self.particle_cloud, weights):
+            particle.w = w
+        return len(beam_ranges)
 
-            particle.w = total_probability_density
-            # rospy.loginfo(particle.w)
+    def laser_beams(self, msg, max_beams=0):
+        """ Returns the angles (relative to the robot) and ranges of the valid beams in the scan msg as numpy arrays
+            max_beams: use at most this many (evenly spread) beams of the scan, 0 uses all of them """
+        valid_ranges = self.filter_laser(msg.ranges)
+        beam_indices = np.array(list(valid_ranges.keys()), dtype=float)
+        beam_angles = (beam_indices + .25*ParticleFilter.TAU) % ParticleFilter.TAU
+        beam_ranges = np.array([valid_ranges[i] for i in valid_ranges])
+        return subsample_beams(beam_angles, beam_ranges, max_beams)
+
+    def refine_robot_pose(self, msg, max_beams=0, beams=None, best_pose=None):
+        """ Improve the pose estimate with scan matching.  Both the weighted mean pose and the best particle are
+            refined against the scan in msg and the better fit of the two becomes the new robot_pose
+            (max_beams and beams as in update_particles_with_laser)
+                best_pose: the x, y, theta of the best particle of the laser update.  Pass it in if the cloud has been
+                           resampled since, resampling evens out the weights (defaults to best_particle_pose()) """
+        beam_angles, beam_ranges = beams or self.laser_beams(msg)
+        beam_angles, beam_ranges = subsample_beams(beam_angles, beam_ranges, max_beams)
+        if len(beam_ranges) < 3:
+            return
+        candidates = [TransformHelpers.convert_pose_to_xy_and_theta(self.robot_pose),
+                      best_pose or self.best_particle_pose()]
+        refined = [refine_pose(self.scorer.occupancy_field, candidate, beam_angles, beam_ranges,
+                               self.refine_iterations, self.laser_max_distance) for candidate in candidates]
+        pose, cost = min(refined, key=lambda result: result[1])
+        self.robot_pose = Particle(pose[0], pose[1], pose[2]).as_pose()
+
+    def best_particle_pose(self):
+        """ Returns the x, y, theta of the most likely particle (a particle with multiplicity m counts m times) """
+        best_particle = max(self.particle_cloud, key=lambda particle: particle.m * particle.w)
+        return best_particle.x, best_particle.y, best_particle.theta
+
+    def particle_cloud_as_array(self):
+        """ Returns the particle cloud as an n x 3 numpy array of x, y, theta """
+        return np.array([[p.x, p.y, p.theta] for p in self.particle_cloud], dtype=float).reshape(-1, 3)
+
+    def record_particles(self, stage, msg):
+        """ Add the particle cloud to the recording (if there is one) as the given stage of the update for the scan
+            msg """
+        if self.cloud_recorder is None:
+            return
+        particles = np.array([[p.x, p.y, p.theta, p.w, p.m] for p in self.particle_cloud], dtype=float)
+        self.cloud_recorder.record(stage, msg.header.stamp.to_sec(), particles)
 
-    def visualize_p_weights(self):
-        """ Produces a plot of particle weights vs. x position """
+    def visualize_p_weights(self, xpos=None, weights=None):
+        """ Produces a plot of particle weights vs. x position
+            xpos, weights: what to plot, defaults to the current cloud (a particle with multiplicity m has weight m*w) """
         # close any figures that are open
         plt.close('all')
 
-        # initialize the things
-        xpos = np.zeros(len(self.particle_cloud))
-        weights = np.zeros(len(self.particle_cloud))
-        x_i = 0
-        weights_i = 0
-
-        # grab the current values
-        for p in self.particle_cloud:
-            xpos[x_i] = p.x 
-            weights[weights_i] = p.w
-
-            x_i += 1
-            weights_i += 1
+        if xpos is None:
+            # grab the current values
+            xpos = np.array([p.x for p in self.particle_cloud])
+            weights = np.array([p.m * p.w for p in self.particle_cloud])
 
         # plotting current xpos and weights
         fig = plt.figure()
@@ -438,7 +1265,7 @@ class ParticleFilter:
             """
         rospy.loginfo("initialize particle cloud")
         self.particle_cloud = []
-        map_info = self.occupancy_field.map.info
+        map_info = self.scorer.occupancy_field.info
         for i in range(self.n_particles):
             x = random_sample()* map_info.width * map_info.resolution * 0.1
             if random_sample() > 0.5:
@@ -457,11 +1284,14 @@ class ParticleFilter:
             sum to 1.0) """
         sum = 0
         for particle in self.particle_cloud:
-            sum += particle.w
+            sum += particle.m * particle.w
         for particle in self.particle_cloud:
             particle.w /= sum
 
     def publish_particles(self, pub):
+        if pub.get_num_connections() == 0:
+            # nobody is listening, don't bother converting the particles
+            return
         particles_conv = []
         for p in self.particle_cloud:
             particles_conv.append(p.as_pose())
@@ -476,6 +1306,9 @@ class ParticleFilter:
             # wait for initialization to complete
             return
 
+        self.scheduler.scan_received(msg.header.stamp)
+        self.poll_profiling()
+
         if not (self.tf_listener.canTransform(self.base_frame, msg.header.frame_id, rospy.Time(0))):
             # need to know how to transform the laser to the base frame
             # this will be given by either Gazebo or neato_node
@@ -500,35 +1333,190 @@ class ParticleFilter:
         # store the the odometry pose in a more convenient format (x,y,theta)
         new_odom_xy_theta = TransformHelpers.convert_pose_to_xy_and_theta(self.odom_pose.pose)
 
+        if self.checkpoint_unverified:
+            self.checkpoint_unverified = False
+            if not self.checkpoint_matches_odometry(new_odom_xy_theta, msg.header.stamp.to_sec()):
+                # start over as if there was no checkpoint
+                self.particle_cloud = []
+
         if not self.particle_cloud:
             # now that we have all of the necessary transforms we can update the particle cloud
             self.initialize_particle_cloud()
             # cache the last odometric pose so we can only update our particle filter if we move more than self.d_thresh or self.a_thresh
             self.current_odom_xy_theta = new_odom_xy_theta
+            self.current_odom_stamp = msg.header.stamp.to_sec()
             # update our map to odom transform now that the particles are initialized
             self.fix_map_to_odom_transform(msg)
         elif (math.fabs(new_odom_xy_theta[0] - self.current_odom_xy_theta[0]) > self.d_thresh or
                       math.fabs(new_odom_xy_theta[1] - self.current_odom_xy_theta[1]) > self.d_thresh or
                       math.fabs(new_odom_xy_theta[2] - self.current_odom_xy_theta[2]) > self.a_thresh):
             # we have moved far enough to do an update!
+            update_start = time.time()
+            self.profiler.begin_update()
+            # decide how big an update we can afford
+            # (the laser cost is measured per valid beam, so that's what we plan with)
+            beams = self.laser_beams(msg)
+            n_beams, n_particles, run_laser = self.scheduler.plan(len(beams[1]))
             self.publish_particles(self.rawcloud_pub)
+            self.record_particles("raw", msg)
+            self.profiler.stage_done("publish")
             
             self.update_particles_with_odom(msg)  # update based on odometry
+            self.current_odom_stamp = msg.header.stamp.to_sec()
+            self.profiler.stage_done("odom")
             self.publish_particles(self.odomcloud_pub)
-            
-            self.update_particles_with_laser(msg)  # update based on laser scan
-            
-            self.publish_particles(self.lasercloud_pub)
-
-            self.resample_particles()  # resample particles to focus on areas of high density
+            self.record_particles("odom", msg)
+            self.profiler.stage_done("publish")
+
+            laser_time = 0.0
+            n_evaluations = 0
+            best_pose = None
+            laser_weights = None
+            if run_laser:
+                laser_start = time.time()
+                n_scored = len(self.particle_cloud)  # only one evaluation per particle, whatever its multiplicity
+                n_evaluations = self.update_particles_with_laser(msg, n_beams, beams) * n_scored  # update based on laser scan
+                laser_time = time.time() - laser_start
+                self.profiler.stage_done("laser")
+                # hold on to what the laser update made of the particles, a resample evens out the weights
+                best_pose = self.best_particle_pose()
+                if self.visualize_weights:
+                    laser_weights = (np.array([p.x for p in self.particle_cloud]),
+                                     np.array([p.m * p.w for p in self.particle_cloud]))
+
+                self.publish_particles(self.lasercloud_pub)
+                self.record_particles("laser", msg)
+                self.profiler.stage_done("publish")
+
+                # resample particles to focus on areas of high density, but only once the weights have degenerated
+                # (or when the scheduler changed the size of the cloud)
+                effective_sample_size = self.effective_sample_size()
+                self.n_updates += 1
+                if effective_sample_size < self.resample_threshold * self.particle_count() or \
+                        n_particles != self.particle_count():
+                    self.resample_particles(n_particles)
+                    self.n_resamples += 1
+                    self.profiler.stage_done("resample")
+                    self.record_particles("resample", msg)
+                self.ess_pub.publish(Float32(data=effective_sample_size))
+                rospy.logdebug("effective sample size %.1f of %d, resampled on %d of %d updates",
+                               effective_sample_size, self.particle_count(), self.n_resamples, self.n_updates)
             self.update_robot_pose()  # update robot's pose
+            if run_laser and self.refine_iterations:
+                self.refine_robot_pose(msg, n_beams, beams, best_pose)  # line the estimate up with the scan
             self.fix_map_to_odom_transform(msg)  # update map to odom transform now that we have new particles
+            self.profiler.stage_done("pose")
+
+            self.scheduler.record(time.time() - update_start, laser_time, n_evaluations, self.particle_count())
+            self.publish_diagnostics()
+            self.profiler.stage_done("publish")
             
             if self.visualize_weights:
-                self.visualize_p_weights()
+                if laser_weights is not None:
+                    self.visualize_p_weights(*laser_weights)
+                else:
+                    self.visualize_p_weights()
+                self.profiler.stage_done("visualize")
+
+        self.save_checkpoint()
 
         # publish particles (so things like rviz can see them)
         self.publish_particles(self.finalcloud_pub)
+        self.record_particles("final", msg)
+        self.profiler.stage_done("publish")
+        self.profiler.end_update()
+
+    def save_checkpoint(self):
+        """ Hand a snapshot of the filter state to the checkpoint writer if checkpoint_period has passed since the
+            last one """
+        now = time.time()
+        if self.checkpoint_writer is None or now - self.last_checkpoint_time < self.checkpoint_period or \
+                not self.particle_cloud or not hasattr(self, 'translation'):
+            return
+        self.last_checkpoint_time = now
+        # copies of a particle are folded into its weight, which describes the same distribution
+        particles = np.array([[p.x, p.y, p.theta, p.m * p.w] for p in self.particle_cloud])
+        self.checkpoint_writer.submit(FilterCheckpoint(particles, self.current_odom_xy_theta, self.translation,
+                                                       self.rotation, self.scorer.occupancy_field.fingerprint(), now,
+                                                       self.odom_frame, self.current_odom_stamp))
+
+    def restore_checkpoint(self):
+        """ Restore the particle cloud, odometry pose and map to odom transform from checkpoint_file if it holds a
+            recent enough checkpoint for the current map and odometry frame.  The first scan then checks that the
+            odometry agrees with it (see checkpoint_matches_odometry) """
+        checkpoint = FilterCheckpoint.load(self.checkpoint_file)
+        if checkpoint is None:
+            return
+        if checkpoint.map_hash != self.scorer.occupancy_field.fingerprint():
+            rospy.logwarn("ignoring checkpoint %s, it was taken on a different map", self.checkpoint_file)
+            return
+        age = time.time() - checkpoint.stamp
+        if self.checkpoint_max_age and age > self.checkpoint_max_age:
+            rospy.logwarn("ignoring checkpoint %s, it is %.0fs old", self.checkpoint_file, age)
+            return
+        if checkpoint.odom_frame != self.odom_frame:
+            rospy.logwarn("ignoring checkpoint %s, it was taken in odometry frame %s instead of %s",
+                          self.checkpoint_file, checkpoint.odom_frame, self.odom_frame)
+            return
+
+        self.particle_cloud = [Particle(x, y, theta, w) for x, y, theta, w in checkpoint.particles]
+        self.current_odom_xy_theta = tuple(checkpoint.odom_xy_theta.tolist())
+        self.translation = tuple(checkpoint.translation.tolist())
+        self.rotation = tuple(checkpoint.rotation.tolist())
+        self.current_odom_stamp = checkpoint.odom_stamp
+        self.checkpoint_unverified = True
+        self.update_robot_pose()
+        rospy.loginfo("restored %d particles from checkpoint %s (%.1fs old)", len(self.particle_cloud),
+                      self.checkpoint_file, age)
+
+    def checkpoint_matches_odometry(self, odom_xy_theta, stamp):
+        """ Check the odometry pose odom_xy_theta of the first scan (taken at stamp) after restoring a checkpoint
+            against the one in the checkpoint.  If the odometry was restarted along with us, the jump between the
+            two isn't motion, and the restored particles and map to odom transform mean nothing anymore. """
+        if stamp < self.current_odom_stamp:
+            rospy.logwarn("discarding checkpoint %s, time went backwards since it was taken (%.1fs)",
+                          self.checkpoint_file, stamp - self.current_odom_stamp)
+            return False
+        distance = math.hypot(odom_xy_theta[0] - self.current_odom_xy_theta[0],
+                              odom_xy_theta[1] - self.current_odom_xy_theta[1])
+        angle = math.fabs(ParticleFilter.angle_diff(odom_xy_theta[2], self.current_odom_xy_theta[2]))
+        if distance > self.checkpoint_odom_tolerance or angle > self.checkpoint_odom_angle_tolerance:
+            rospy.logwarn("discarding checkpoint %s, odometry jumped %.2fm and %.2frad since it was taken",
+                          self.checkpoint_file, distance, angle)
+            return False
+        return True
+
+    def publish_diagnostics(self):
+        """ Publish what the update scheduler decided for the last update (and how the likelihood cache, early
+            termination and cloud recorder are doing) """
+        if self.diagnostics_pub.get_num_connections() == 0:
+            return
+        name = rospy.get_name() + ("/" + self.namespace if self.namespace else "")
+        status = [self.scheduler.diagnostics(name + ": update scheduler")]
+        if self.likelihood_cache is not None:
+            values = [("hit rate", self.likelihood_cache.hit_rate()), ("hits", self.likelihood_cache.hits),
+                      ("lookups", self.likelihood_cache.lookups), ("entries", len(self.likelihood_cache.entries))]
+            status.append(DiagnosticStatus(level=DiagnosticStatus.OK, name=name + ": likelihood cache",
+                                           message="%.0f%% hit rate" % (100 * self.likelihood_cache.hit_rate()),
+                                           hardware_id="",
+                                           values=[KeyValue(key=key, value=str(value)) for key, value in values]))
+        if self.early_termination_margin > 0:
+            skipped = float(self.n_skipped_beam_evaluations) / max(self.n_beam_evaluations, 1)
+            values = [("skipped", self.n_skipped_beam_evaluations), ("beam evaluations", self.n_beam_evaluations),
+                      ("margin", self.early_termination_margin)]
+            status.append(DiagnosticStatus(level=DiagnosticStatus.OK, name=name + ": early termination",
+                                           message="%.0f%% of beam evaluations skipped" % (100 * skipped),
+                                           hardware_id="",
+                                           values=[KeyValue(key=key, value=str(value)) for key, value in values]))
+        if self.cloud_recorder is not None:
+            values = [("file", self.cloud_recorder.filename), ("recorded", self.cloud_recorder.n_recorded),
+                      ("dropped", self.cloud_recorder.n_dropped)]
+            status.append(DiagnosticStatus(level=DiagnosticStatus.WARN if self.cloud_recorder.n_dropped else
+                                           DiagnosticStatus.OK, name=name + ": cloud recorder",
+                                           message="%d frames dropped" % self.cloud_recorder.n_dropped,
+                                           hardware_id="",
+                                           values=[KeyValue(key=key, value=str(value)) for key, value in values]))
+        self.diagnostics_pub.publish(DiagnosticArray(header=Header(stamp=rospy.Time.now()), status=status))
 
     def fix_map_to_odom_transform(self, msg):
         """ Super tricky code to properly update map to odom transform... do not modify this... Difficulty level infinity. """
@@ -541,7 +1529,8 @@ class ParticleFilter:
     def broadcast_last_transform(self):
         """ Make sure that we are always broadcasting the last map to odom transformation.
             This is necessary so things like move_base can work properly. """
-        if not (hasattr(self, 'translation') and hasattr(self, 'rotation')):
+        if not (hasattr(self, 'translation') and hasattr(self, 'rotation')) or self.checkpoint_unverified:
+            # (a restored transform is only broadcast once the odometry has confirmed it)
             return
         self.tf_broadcaster.sendTransform(self.translation, self.rotation, rospy.get_rostime(), self.odom_frame,
                                           self.map_frame)
@@ -555,7 +1544,42 @@ class ParticleFilter:
         return valid_ranges
 
 
+class ParticleFilterHost:
+    """ Runs several independent particle filters inside one ROS node (for fleet simulation, parameter sweeps...).
+        Every filter has its own namespace and with it its own topics, frames and parameters.  The map, the tf
+        listener/broadcaster and the laser scorer are shared, so the laser updates of filters whose scans arrive
+        together are scored with one vectorized lookup.
+        Attributes:
+            scorer: the BatchScorer shared by all of the filters, it holds the map (scorer.occupancy_field)
+            map_updater: keeps the shared map up to date with the map topic
+            tf_listener: listener for coordinate transforms
+            tf_broadcaster: broadcaster for coordinate transforms
+            filters: the hosted ParticleFilter instances
+    """
+
+    def __init__(self, namespaces, batch_window=0.005, map_file="", map_topic="map"):
+        """ Construct a host with one filter per entry in namespaces.
+                namespaces: the namespace of each filter (e.g. ["robot1", "robot2"])
+                batch_window: how long (in seconds) a laser update waits for the other filters to join its batch
+                map_file: a map_server YAML file to load the map from ("" asks the map server for it)
+                map_topic: the topic to listen to for map changes """
+        self.scorer = BatchScorer(load_occupancy_field(map_file), batch_window)
+        self.map_updater = OccupancyFieldUpdater(self.scorer, map_topic)
+
+        self.tf_listener = TransformListener()
+        self.tf_broadcaster = TransformBroadcaster()
+
+        self.filters = [ParticleFilter(namespace, self.scorer, self.tf_listener, self.tf_broadcaster)
+                        for namespace in namespaces]
+
+    def broadcast_last_transforms(self):
+        """ Broadcast the last map to odom transform of every filter """
+        for particle_filter in self.filters:
+            particle_filter.broadcast_last_transform()
+
+
 if __name__ == '__main__':
+    rospy.init_node('pf')  # tell roscore that we are creating a new node named "pf"
     n = ParticleFilter()
     r = rospy.Rate(5)
 
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+""" Parameter sweeps for the particle filter over recorded bagfiles.
+
+    usage: pf_sweep.py grid.yaml results.csv [--bags a.bag b.bag] [--map map.yaml] [--processes 4] [--repeats 3]
+                       [--error-cap 2.0]
+
+    grid.yaml maps filter parameters (the names of the ~ parameters of ParticleFilter) to the values to try, e.g.
+        n_particles: [30, 100, 300]
+        d_thresh: [0.1, 0.2]
+        laser_sigma: [0.05, 0.1]
+    Every combination is run headless (no roscore needed) over every bagfile, on a pool of worker processes.  The
+    accuracy, convergence time and CPU cost of each run are appended to results.csv as soon as the run finishes, so
+    running an interrupted sweep again with the same arguments only does the runs that are missing.
+
+    There is no ground truth in the bagfiles, so accuracy is measured as how well the scan lines up with the map at the
+    estimated pose: the mean distance from the beam endpoints to the closest obstacle, capped at --error-cap (the same
+    for every configuration, so the errors of different configurations can be compared).  The pose estimate is refined
+    with scan matching (refine_iterations) which minimizes exactly this distance, so the refined errors flatter the
+    filter.  The *_unrefined columns score the weighted mean of the particles instead, which is the estimate before
+    refinement and says more about the particle filter itself.
+
+    The update scheduler is switched off (an infinite update_budget) unless the grid sets update_budget, otherwise
+    how much of each update actually runs would depend on how busy the machine is.
+"""
+import os
+import csv
+import glob
+import json
+import time
+import argparse
+import itertools
+import resource
+import multiprocessing
+
+import yaml
+import numpy as np
+
+import rospy
+import rosbag
+import tf
+from geometry_msgs.msg import TransformStamped
+
+from pf_level2 import ParticleFilter, BatchScorer, TransformHelpers, load_occupancy_field, scan_match_residuals
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DEFAULT_BAGS = os.path.join(PACKAGE_DIR, "..", "bagfiles", "*.bag")
+DEFAULT_MAP = os.path.join(PACKAGE_DIR, "maps", "STAR_map_cleaned.yaml")
+
+RESULT_COLUMNS = ["scans", "updates", "resamples", "mean_error", "final_error", "convergence_time",
+                  "mean_error_unrefined", "final_error_unrefined", "convergence_time_unrefined", "cpu_time",
+                  "cpu_per_scan"]
+
+# the occupancy fields loaded by this (worker) process, by map file
+occupancy_fields = {}
+
+
+def expand_grid(grid):
+    """ Returns every combination of the parameter values in grid (a dictionary of name: list of values) as a list of
+        dictionaries """
+    names = sorted(grid)
+    values = [grid[name] if isinstance(grid[name], list) else [grid[name]] for name in names]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def run_key(bag_file, config_json, seed):
+    """ Identifies a run in the results table """
+    return os.path.basename(bag_file), config_json, str(seed)
+
+
+def completed_runs(results_file):
+    """ The keys (see run_key) of the runs already in results_file, and the header of the file (None if it doesn't
+        exist yet) """
+    if not os.path.exists(results_file):
+        return set(), None
+    with open(results_file) as f:
+        reader = csv.DictReader(f)
+        return set(run_key(row["bag"], row["config"], row["seed"]) for row in reader), reader.fieldnames
+
+
+def odometry_transform(msg):
+    """ The odom to base transform in a nav_msgs/Odometry message, as a geometry_msgs/TransformStamped """
+    transform = TransformStamped()
+    transform.header = msg.header
+    transform.child_frame_id = msg.child_frame_id
+    transform.transform.translation.x = msg.pose.pose.position.x
+    transform.transform.translation.y = msg.pose.pose.position.y
+    transform.transform.translation.z = msg.pose.pose.position.z
+    transform.transform.rotation = msg.pose.pose.orientation
+    return transform
+
+
+def identity_transform(parent_frame, child_frame, stamp):
+    """ A geometry_msgs/TransformStamped that puts child_frame right on top of parent_frame """
+    transform = TransformStamped()
+    transform.header.frame_id = parent_frame
+    transform.header.stamp = stamp
+    transform.child_frame_id = child_frame
+    transform.transform.rotation.w = 1.0
+    return transform
+
+
+def cpu_seconds():
+    """ The CPU time (user and system) this process has used so far """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def mean_particle_pose(particle_cloud):
+    """ The weighted mean x, y, theta of the particles (what ParticleFilter.update_robot_pose estimates before the
+        pose is refined) """
+    particles = np.array([[p.x, p.y, p.theta] for p in particle_cloud])
+    weights = np.array([p.m * p.w for p in particle_cloud])
+    return tuple(np.average(particles, axis=0, weights=weights))
+
+
+def error_statistics(stamps, errors, converged_distance):
+    """ The mean error over the second half of a run, the final error and how long it took for the error to drop
+        below converged_distance (empty if it never did) """
+    converged = [stamp for stamp, error in zip(stamps, errors) if error < converged_distance]
+    return (np.mean(errors[len(errors) // 2:]) if errors else "",
+            errors[-1] if errors else "",
+            converged[0] - stamps[0] if converged else "")
+
+
+def run_configuration(task):
+    """ Run a headless filter with one configuration over one bagfile and measure how it did.  task is a tuple
+        (bag_file, map_file, scan_topic, config_json, seed, converged_distance, error_cap), returns a row of the
+        results table """
+    bag_file, map_file, scan_topic, config_json, seed, converged_distance, error_cap = task
+    config = json.loads(config_json)
+    np.random.seed(seed)
+
+    if map_file not in occupancy_fields:
+        occupancy_fields[map_file] = load_occupancy_field(map_file)
+    field = occupancy_fields[map_file]
+
+    params = dict(config)
+    params["visualize_weights"] = False
+    params.setdefault("update_budget", float("inf"))
+    transformer = tf.TransformerROS(True, rospy.Duration(3600.0))
+    particle_filter = ParticleFilter(scorer=BatchScorer(field), tf_listener=transformer, params=params, headless=True)
+
+    stamps = []
+    errors = []
+    unrefined_errors = []
+    laser_frame_missing = None
+    cpu_time = 0.0  # only the time spent in the filter, not in reading the bag or measuring the error
+    bag = rosbag.Bag(bag_file)
+    try:
+        for topic, msg, t in bag.read_messages(topics=[scan_topic, "/tf", "/tf_static", "/odom"]):
+            if topic in ("/tf", "/tf_static"):
+                for transform in msg.transforms:
+                    transformer.setTransform(transform)
+            elif topic == "/odom":
+                transformer.setTransform(odometry_transform(msg))
+            else:
+                if laser_frame_missing is None:
+                    laser_frame_missing = not transformer.frameExists(msg.header.frame_id)
+                if laser_frame_missing:
+                    # not every bagfile has the laser transform, assume the laser sits at the center of the robot
+                    transformer.setTransform(identity_transform(particle_filter.base_frame, msg.header.frame_id,
+                                                                msg.header.stamp))
+                start = cpu_seconds()
+                particle_filter.scan_received(msg)
+                cpu_time += cpu_seconds() - start
+
+                if particle_filter.particle_cloud:
+                    beam_angles, beam_ranges = particle_filter.laser_beams(msg)
+                    if len(beam_ranges):
+                        pose = TransformHelpers.convert_pose_to_xy_and_theta(particle_filter.robot_pose)
+                        residuals, jacobian = scan_match_residuals(field, pose, beam_angles, beam_ranges, error_cap)
+                        unrefined_residuals, jacobian = scan_match_residuals(
+                            field, mean_particle_pose(particle_filter.particle_cloud), beam_angles, beam_ranges,
+                            error_cap)
+                        stamps.append(msg.header.stamp.to_sec())
+                        errors.append(np.mean(residuals))
+                        unrefined_errors.append(np.mean(unrefined_residuals))
+    finally:
+        bag.close()
+
+    row = {"bag": os.path.basename(bag_file), "seed": seed, "config": config_json,
+           "scans": len(errors),
+           "updates": particle_filter.n_updates,
+           "resamples": particle_filter.n_resamples,
+           "cpu_time": cpu_time,
+           "cpu_per_scan": cpu_time / len(errors) if errors else ""}
+    row["mean_error"], row["final_error"], row["convergence_time"] = error_statistics(stamps, errors,
+                                                                                      converged_distance)
+    (row["mean_error_unrefined"], row["final_error_unrefined"],
+     row["convergence_time_unrefined"]) = error_statistics(stamps, unrefined_errors, converged_distance)
+    row.update(config)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a parameter sweep of the particle filter over bagfiles")
+    parser.add_argument("grid", help="YAML file mapping parameter names to the list of values to try")
+    parser.add_argument("results", help="CSV file the results are appended to (existing runs are skipped)")
+    parser.add_argument("--bags", nargs="+", default=sorted(glob.glob(DEFAULT_BAGS)), help="bagfiles to run over")
+    parser.add_argument("--map", default=DEFAULT_MAP, help="map_server YAML file of the map to localize in")
+    parser.add_argument("--scan-topic", default="/scan", help="the laser scan topic in the bagfiles")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(), help="number of workers")
+    parser.add_argument("--repeats", type=int, default=1, help="runs per configuration and bagfile (random seeds)")
+    parser.add_argument("--converged-distance", type=float, default=0.05,
+                        help="mean scan to map distance (in meters) below which the filter counts as converged")
+    parser.add_argument("--error-cap", type=float, default=2.0,
+                        help="distance (in meters) at which the scan to map distance of a beam is capped")
+    args = parser.parse_args()
+
+    with open(args.grid) as f:
+        grid = yaml.safe_load(f)
+    columns = ["bag", "seed", "config"] + sorted(grid) + RESULT_COLUMNS
+
+    done, header = completed_runs(args.results)
+    if header is not None and header != columns:
+        parser.error("%s holds the results of a different grid or version of this script (columns %s)" %
+                     (args.results, ", ".join(header)))
+
+    tasks = []
+    for bag_file in args.bags:
+        for config in expand_grid(grid):
+            config_json = json.dumps(config, sort_keys=True)
+            for seed in range(args.repeats):
+                if run_key(bag_file, config_json, seed) not in done:
+                    tasks.append((bag_file, args.map, args.scan_topic, config_json, seed, args.converged_distance,
+                                  args.error_cap))
+    print("%d runs to do, %d already done" % (len(tasks), len(done)))
+
+    pool = multiprocessing.Pool(args.processes)
+    start = time.time()
+    with open(args.results, "a") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        if header is None:
+            writer.writeheader()
+        for i, row in enumerate(pool.imap_unordered(run_configuration, tasks)):
+            # write every result as soon as it comes in, so an interrupted sweep can be resumed
+            writer.writerow(row)
+            f.flush()
+            print("%d/%d done (%.0fs)" % (i + 1, len(tasks), time.time() - start))
+    pool.close()
+    pool.join()
+
+
+if __name__ == '__main__':
+    main()
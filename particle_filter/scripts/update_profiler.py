@@ -0,0 +1,200 @@
+""" Opt-in profiling of the filter update: memory allocated per stage of an update (with tracemalloc), the sites that
+    allocate the most, and cProfile dumps of a given number of updates.  All of it can be switched on and off while
+    the node is running. """
+import os
+import time
+import threading
+import cProfile
+
+import rospy
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2 doesn't have tracemalloc, only the cProfile dumps are available there
+    tracemalloc = None
+
+# tracemalloc is global to the process, but every filter of a ParticleFilterHost has its own profiler, so tracing is
+# started by the first profiler that wants it and stopped when the last one is done with it
+tracing_lock = threading.Lock()
+n_tracing = 0
+
+
+def start_tracing():
+    global n_tracing
+    with tracing_lock:
+        n_tracing += 1
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+def stop_tracing():
+    global n_tracing
+    with tracing_lock:
+        n_tracing -= 1
+        if n_tracing == 0 and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def can_measure_peaks():
+    """ Whether the peak of a stage can be measured: tracemalloc has a single peak for the whole process, which can
+        only be reset for a stage if nobody else (another filter in this process) is using it """
+    return hasattr(tracemalloc, "reset_peak") and n_tracing == 1
+
+
+class StageStatistics:
+    """ Memory statistics of one stage of the update, accumulated over the updates since the last report
+        Attributes:
+            n: the number of updates that went through the stage
+            allocated: the total number of bytes still allocated at the end of the stage (i.e. net of what the
+                       stage freed again)
+            peak: the most memory (in bytes, above what was allocated when the stage started) the stage needed at
+                  once, None if it can't be measured (see can_measure_peaks)
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.allocated = 0
+        self.peak = None
+
+    def add(self, allocated, peak):
+        self.n += 1
+        self.allocated += allocated
+        if peak is not None:
+            self.peak = peak if self.peak is None else max(self.peak, peak)
+
+
+class UpdateProfiler:
+    """ Measures the stages of the filter updates.  An update is bracketed by begin_update and end_update, and
+        stage_done(name) marks the end of a stage (that started at the previous mark).  When nothing is switched on
+        these calls return right away.
+        Attributes:
+            name: what the reports and dump files are labeled with
+            memory: whether allocations are being traced
+            report_period: how often (in seconds) the memory statistics are logged
+            top_sites: how many allocation sites to list in a report
+            dump_prefix: the cProfile dumps are written to dump_prefix + "_<time>.prof"
+            n_capture: the number of updates (including the current one) still to be captured with cProfile
+            stages: the StageStatistics of every stage, by name
+    """
+
+    def __init__(self, name, dump_prefix, report_period=30.0, top_sites=10):
+        self.name = name
+        self.memory = False
+        self.report_period = report_period
+        self.top_sites = top_sites
+        self.dump_prefix = dump_prefix
+        self.n_capture = 0
+        self.profile = None
+        self.stages = {}
+        self.last_report = time.time()
+        self.last_snapshot = None
+        self.in_update = False
+        self.mark = 0
+
+    def active(self):
+        return self.memory or self.n_capture > 0
+
+    def set_memory(self, enabled):
+        """ Switch the tracing of allocations on or off """
+        if enabled == self.memory:
+            return
+        if enabled and tracemalloc is None:
+            rospy.logwarn("%s: memory profiling needs tracemalloc (python 3)", self.name)
+            return
+        self.memory = enabled
+        self.stages = {}
+        self.last_snapshot = None
+        self.last_report = time.time()
+        if enabled:
+            start_tracing()
+        else:
+            stop_tracing()
+        rospy.loginfo("%s: memory profiling %s", self.name, "on" if enabled else "off")
+
+    def capture(self, n_updates):
+        """ Profile the next n_updates updates with cProfile and dump the statistics once they are done """
+        self.n_capture = n_updates
+        self.profile = cProfile.Profile()
+        rospy.loginfo("%s: profiling the next %d updates", self.name, n_updates)
+
+    def begin_update(self):
+        if not self.active():
+            return
+        self.in_update = True
+        if self.n_capture > 0:
+            self.profile.enable()
+        if self.memory:
+            self.start_stage()
+
+    def start_stage(self):
+        if can_measure_peaks():
+            tracemalloc.reset_peak()
+        self.mark = tracemalloc.get_traced_memory()[0]
+
+    def stage_done(self, name):
+        """ Record the memory allocated since the previous mark as stage name """
+        if not (self.memory and self.in_update):
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        if name not in self.stages:
+            self.stages[name] = StageStatistics()
+        self.stages[name].add(current - self.mark, peak - self.mark if can_measure_peaks() else None)
+        self.start_stage()
+
+    def end_update(self):
+        if not self.in_update:
+            return
+        self.in_update = False
+        if self.n_capture > 0:
+            self.profile.disable()
+            self.n_capture -= 1
+            if self.n_capture == 0:
+                self.dump_profile()
+        if self.memory and time.time() - self.last_report > self.report_period:
+            self.report()
+
+    def dump_profile(self):
+        filename = "%s_%s.prof" % (self.dump_prefix, time.strftime("%Y%m%d_%H%M%S"))
+        try:
+            directory = os.path.dirname(filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.profile.dump_stats(filename)
+            rospy.loginfo("%s: wrote profile to %s (look at it with python -m pstats %s)", self.name, filename,
+                          filename)
+        except Exception as e:
+            rospy.logwarn("%s: failed to write profile %s: %s", self.name, filename, e)
+        self.profile = None
+
+    def report(self):
+        """ Log the memory statistics of each stage, the sites that hold the most memory and the sites that grew the
+            most since the last report, then start over """
+        self.last_report = time.time()
+        if not tracemalloc.is_tracing():
+            rospy.logwarn("%s: no memory report, tracemalloc was stopped by someone else", self.name)
+            self.stages = {}
+            self.last_snapshot = None
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ["%s: %.1f MB traced (%.1f MB peak)" % (self.name, current / 1e6, peak / 1e6)]
+        if n_tracing > 1:
+            lines.append("  (%d filters are tracing, the allocations of their threads are counted too)" % n_tracing)
+        for name, stage in sorted(self.stages.items()):
+            lines.append("  %-10s %8.1f kB allocated per update%s" %
+                         (name, stage.allocated / 1e3 / stage.n,
+                          ", %.1f kB peak" % (stage.peak / 1e3) if stage.peak is not None else ""))
+        self.stages = {}
+
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>")])
+        lines.append("  top allocation sites:")
+        for statistic in snapshot.statistics("lineno")[:self.top_sites]:
+            lines.append("    " + str(statistic))
+        if self.last_snapshot is not None:
+            lines.append("  biggest growth since the last report:")
+            for statistic in snapshot.compare_to(self.last_snapshot, "lineno")[:self.top_sites]:
+                lines.append("    " + str(statistic))
+        self.last_snapshot = snapshot
+        rospy.loginfo("\n".join(lines))